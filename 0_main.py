@@ -3,13 +3,16 @@
 
 import os
 import sys
-import shutil
 
 # pcraster dynamic framework is used.
 from pcraster.framework import DynamicFramework
 
 # The calculation script (engine) is imported from the following module.
 from dynamic_calc_framework import CalcFramework
+from batch_calc_framework import BatchCalcFramework
+from matrix_calc_framework import MatrixCalcFramework
+from parallel_batch_framework import ParallelBatchCalcFramework
+from chunked_calc_framework import ChunkedCalcFramework
 
 # time object
 from currTimeStep import ModelTime
@@ -17,6 +20,12 @@ from currTimeStep import ModelTime
 # utility module:
 import virtualOS as vos
 
+# unique temporary workspaces (on /dev/shm if possible), removed at exit
+import workspace
+
+# timing and counters of the calculation stages (optional)
+import instrumentation
+
 import logging
 logger = logging.getLogger(__name__)
 
@@ -27,42 +36,89 @@ output_files = {}
 output_files['folder']          = "/scratch/edwin/tmp_test_for_nils/"
 # - name of output file (txt file)
 output_files['output_txt_file'] = output_files['folder'] + "003303.txt"
+# - output format: None     (as in the earlier versions: "txt" for a single catchment, "table" in batch mode; 
+#                            written to the output_txt_file above),
+#                  "txt"    (text sentences), 
+#                  "csv"    (columns: date, station_id, mean_mm_day, catchment_area), 
+#                  "table"  (csv with one column for every station), "npy" or "netcdf" 
+#   (with an output format, the extension of the output file follows the format) 
+output_files['output_format']   = None
+# - number of time steps kept in memory before they are written to the output file
+output_files['flush_interval']  = 30
+# - print the results to the screen
+output_files['verbose']         = False
 
 # input
 input_files = {}
 # - input folder where you store tif file 
 input_files["folder"]                         = "/scratch/edwin/for_nils/data_from_nils/"
 input_files["tif_catchment_file"]             = input_files["folder"] + "stID_003303.tif"
+# - batch mode: a list of tif files or a folder containing stID_*.tif files (output: one column per station)
+#~ input_files["tif_catchment_files"]            = input_files["folder"]
 
 # general input data                          
 input_files["netcdf_runoff"]                  = {}
-# - netcdf input file for runoff
+# - netcdf input file for runoff: a file name, a file name pattern with %Y for yearly files or a list of files
+#   (with yearly files, startDate and endDate may cover several years)
 input_files["netcdf_runoff"]["file_name"]     = "/scratch/edwin/for_nils/general_data/e2o_univu_wrr1_glob30_day_Runoff_1979.nc"    # unit: kg m-2 s-1
+#~ input_files["netcdf_runoff"]["file_name"]     = "/scratch/edwin/for_nils/general_data/e2o_univu_wrr1_glob30_day_Runoff_%Y.nc"      # unit: kg m-2 s-1
 input_files["netcdf_runoff"]["variable_name"] = "Runoff"
+# - number of time steps read from the netcdf file in one call ("auto": based on the netcdf chunk size; None: one time step per call)
+input_files["netcdf_runoff"]["time_slab_size"] = "auto"
+# - number of time steps read ahead in a background thread (None: no prefetching)
+input_files["netcdf_runoff"]["prefetch_depth"] = None
+# - reduce the runoff at the native resolution of the netcdf file, with the catchment area within every netcdf cell 
+#   as the weight (instead of resampling every field to the clone; equal up to the float rounding)
+input_files["netcdf_runoff"]["native_resolution"] = False
+# - resample the runoff fields to the clone with a sparse regridding operator, built once per netcdf grid and clone:
+#   "nearest" or "conservative" (area weighted; also for non-integer cell size ratios). None: replicate the netcdf 
+#   cells (the cell size ratio must be an integer). Not used with native_resolution.
+input_files["netcdf_runoff"]["regrid_method"] = None
+
+# calculation engine: "dynamic" (pcraster DynamicFramework, one time step per call) or 
+#                     "matrix"  (the entire period in blocks of time steps, same text output; only for a single catchment) 
+#                     "chunks"  (as "matrix", with the period split into chunks calculated by number_of_workers processes)
+calculation_engine = "dynamic"
+# - chunks of the "chunks" engine: "year" (one for every year, i.e. every yearly netcdf file) or a number of days
+time_chunk = "year"
+
+# number of worker processes (0: one for every core)
+# - batch mode: each worker reduces a share of the stations (None: a single process, see BatchCalcFramework). 
+#   Every block of time steps is read once into a file in the workspace (/dev/shm if possible) shared by the workers.
+# - "chunks" engine: each worker calculates a chunk of the period (None: one for every core)
+number_of_workers = None
+
+# folder for the prepared (resampled) catchments, so that the next runs can skip the warping (None: no cache)
+input_files["catchment_cache_folder"]         = "/scratch/edwin/for_nils/catchment_cache/"
+
+# instrumentation report (JSON): wall time and calls of every stage and counters (netcdf bytes read, cache hits, 
+# subprocess launches); a summary table is printed at the end of the run (None: no instrumentation)
+instrumentation_report_file = None
+#~ instrumentation_report_file = output_files['folder'] + "instrumentation.json"
+
+# water balance checks of the virtualOS functions (switch off in production runs to skip them entirely)
+water_balance_checks = True
 
 # start and end dates (based on input netcdf files)
 startDate     = "1979-01-01"
 endDate       = "1979-12-31" 
 
-# prepare output folder
-try:
-    os.makedirs(output_files['folder'])
-except:
-    shutil.rmtree(output_files['folder'])
-    pass
-
-# temporary output folder:
-output_files['tmp_output_folder'] = output_files['folder'] + "/tmp"
-try:
-    os.makedirs(output_files['tmp_output_folder'])
-except:
-    os.remove(output_files['tmp_output_folder'])
-    pass
+# folder for the temporary workspaces (None: /dev/shm if it has enough free space, otherwise the output folder; 
+# a folder given here is always used)
+workspace_folder = None
 
 ###########################################################################################################
 
 def main():
     
+    # prepare output folder (existing files of other runs are kept)
+    vos.makeDir(output_files['folder'])
+
+    # temporary output folder: a unique workspace for this run (so that concurrent runs do not remove each 
+    # other's temporary files), removed at exit
+    output_files['workspace_folder']  = workspace_folder
+    output_files['tmp_output_folder'] = workspace.createWorkspace(fallbackFolder = output_files['folder'], baseFolder = workspace_folder)
+    
     # time object
     modelTime = ModelTime() # timeStep info: year, month, day, doy, hour, etc
     modelTime.getStartEndTimeSteps(startDate, endDate)
@@ -70,15 +126,58 @@ def main():
     # - cell area (unit: m2) for every 0.05 arc-degree
     input_files["cellarea_0.05deg_file"] = "australia_cellsize0.05deg.map"	                         # unit: m2
     input_files["cellarea_0.05deg_file"] = os.path.abspath(input_files["cellarea_0.05deg_file"])
+    # - source of the cell areas: "map" (the cell area map above) or "analytic" (calculated for the clone grid; 
+    #   the map is then only used as the clone)
+    input_files["cell_area_source"]      = "map"
+
+    vos.waterBalanceChecks = water_balance_checks
+
+    # instrumentation (disabled by default)
+    if instrumentation_report_file != None: instrumentation.enable()
 
     # modeling framework
-    calculationModel = CalcFramework(modelTime,\
-                                     input_files, \
-                                     output_files)
+    if "tif_catchment_files" in input_files.keys() and number_of_workers != None:
+        calculationModel = ParallelBatchCalcFramework(modelTime,\
+                                                      input_files, \
+                                                      output_files, \
+                                                      number_of_workers = number_of_workers if number_of_workers > 0 else None)
+        calculationModel.run()
+        reportInstrumentation()
+        return 0
+    elif "tif_catchment_files" in input_files.keys():
+        calculationModel = BatchCalcFramework(modelTime,\
+                                              input_files, \
+                                              output_files)
+    elif calculation_engine == "chunks":
+        calculationModel = ChunkedCalcFramework(modelTime,\
+                                                input_files, \
+                                                output_files, \
+                                                chunk = time_chunk, \
+                                                number_of_workers = number_of_workers if number_of_workers else None)
+        calculationModel.run()
+        reportInstrumentation()
+        return 0
+    elif calculation_engine == "matrix":
+        calculationModel = MatrixCalcFramework(modelTime,\
+                                               input_files, \
+                                               output_files)
+        calculationModel.run()
+        reportInstrumentation()
+        return 0
+    else:
+        calculationModel = CalcFramework(modelTime,\
+                                         input_files, \
+                                         output_files)
 
     dynamic_framework = DynamicFramework(calculationModel, modelTime.nrOfTimeSteps)
     dynamic_framework.setQuiet(True)
     dynamic_framework.run()
+    reportInstrumentation()
+
+def reportInstrumentation():
+    if not instrumentation.enabled: return
+    instrumentation.printSummary()
+    instrumentation.writeReport(instrumentation_report_file)
 
 if __name__ == '__main__':
     sys.exit(main())
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import glob
+
+import numpy as np
+
+import pcraster as pcr
+from pcraster.framework import DynamicModel
+
+import virtualOS as vos
+from netcdf_prefetcher import startPrefetcher
+from result_writers import getResultWriter
+from sparse_catchment import getSparseCatchment, readCellArea
+import instrumentation
+
+import logging
+logger = logging.getLogger(__name__)
+
+def getCatchmentTifFiles(tif_catchment_files):
+    # tif_catchment_files: a list of tif files or a directory containing stID_*.tif files
+    if isinstance(tif_catchment_files, (list, tuple)):
+        return list(tif_catchment_files)
+    if os.path.isdir(tif_catchment_files):
+        return sorted(glob.glob(os.path.join(tif_catchment_files, "stID_*.tif")))
+    return [tif_catchment_files]
+
+class BatchCalcFramework(DynamicModel):
+    # Catchment averages for many catchments in a single pass over the input netcdf file.
+    #
+    # All catchments are put on integer label grids (on the clone). Each day, the runoff field is read once
+    # and the totals of all catchments are calculated with a weighted bincount.
+    # Nested/overlapping catchments are placed on separate label grids (layers).
+    # With input_files["netcdf_runoff"]["native_resolution"], the layers are aggregated to the native grid of the
+    # netcdf file (see getNativeLayers) and the runoff fields are not resampled to the clone.
+
+    def __init__(self, modelTime, \
+                       input_files, \
+                       output_files):
+        DynamicModel.__init__(self)
+
+        self.input_files  = input_files
+        self.output_files = output_files
+
+        # use cell area as the clone map
+        self.clone_map_file = self.input_files["cellarea_0.05deg_file"]
+        pcr.setclone( self.clone_map_file)
+
+        # cell area (m2)
+        cell_area = readCellArea(self.input_files, self.clone_map_file, self.output_files['tmp_output_folder'])
+
+        # list of catchment tif files
+        self.tif_catchment_files = getCatchmentTifFiles(self.input_files["tif_catchment_files"])
+        self.station_ids = [vos.getStationID(tif_file) for tif_file in self.tif_catchment_files]
+        number_of_catchments = len(self.tif_catchment_files)
+        logger.info('Number of catchments: ' + str(number_of_catchments))
+
+        # label grids (0: no catchment; i+1: the i-th catchment), only on the active cells
+        label_grids = []
+        self.catchment_area = np.zeros(number_of_catchments, dtype = np.float64)  # unit: m2
+        for i_catchment, tif_file in enumerate(self.tif_catchment_files):
+
+            # the catchment as its active cells (see sparse_catchment; from the cache if available)
+            catchment = getSparseCatchment(tif_file, \
+                                           self.clone_map_file, \
+                                           cell_area, \
+                                           self.output_files['tmp_output_folder'], \
+                                           cache_folder = self.input_files.get("catchment_cache_folder"), \
+                                           station_id = self.station_ids[i_catchment], \
+                                           cell_area_source = self.input_files.get("cell_area_source", "map"))
+            self.catchment_area[i_catchment] = catchment.catchment_area
+
+            # use the first label grid that does not overlap with this catchment
+            for label_grid in label_grids:
+                if not np.any(label_grid[catchment.active_index]):
+                    break
+            else:
+                label_grid = np.zeros(cell_area.size, dtype = np.int32)
+                label_grids.append(label_grid)
+            label_grid[catchment.active_index] = i_catchment + 1
+
+            logger.info('The catchment area of ' + str(self.station_ids[i_catchment]) + ' is (m2): ' + str(self.catchment_area[i_catchment]))
+
+        # for every label grid: the active cell indices, labels and cell areas
+        self.layers = []
+        for label_grid in label_grids:
+            cell_index = np.flatnonzero(label_grid > 0)
+            self.layers.append((cell_index, label_grid[cell_index], cell_area.ravel()[cell_index].astype(np.float32)))
+        logger.info('Number of label grids: ' + str(len(self.layers)))
+        self.clone_shape = cell_area.shape
+
+        # reduce the runoff at the native resolution of the netcdf file
+        self.native_resolution = self.input_files["netcdf_runoff"].get("native_resolution", False)
+        self.native_layers = {}
+
+        # resample the runoff fields with a cached sparse regridding operator (None: replicate the input cells)
+        self.regrid_method = self.input_files["netcdf_runoff"].get("regrid_method")
+
+        # output file (see result_writers; e.g. "table": one column for every station)
+        self.result_writer = getResultWriter(self.output_files, self.station_ids, self.catchment_area, default_format = "table")
+
+        # time variable/object
+        self.modelTime = modelTime
+
+        # optional: read the runoff of the following time steps in a background thread
+        self.prefetcher = startPrefetcher(self.input_files["netcdf_runoff"], \
+                                          self.modelTime.getAllFullDates(), \
+                                          cloneMapFileName = self.clone_map_file, \
+                                          nativeResolution = self.native_resolution, \
+                                          regridMethod = self.regrid_method)
+
+    def getNativeLayers(self, factor, coarse_cols):
+        # The layers aggregated (once) to a grid that is 'factor' times coarser than the clone (with coarse_cols columns):
+        # for every layer: the flat indices of the coarse cells, the labels and the catchment cell areas within them.
+        key = (factor, coarse_cols)
+        if key not in self.native_layers:
+            number_of_labels = len(self.station_ids) + 1
+            self.native_layers[key] = []
+            for cell_index, labels, cell_area in self.layers:
+                rows, cols = np.unravel_index(cell_index, self.clone_shape)
+                coarse_index = (rows // factor).astype(np.int64) * coarse_cols + cols // factor
+                coarse_label, inverse = np.unique(coarse_index * number_of_labels + labels, return_inverse = True)
+                weights = np.bincount(inverse, weights = cell_area.astype(np.float64))
+                self.native_layers[key].append((coarse_label // number_of_labels, \
+                                                (coarse_label %  number_of_labels).astype(np.int32), weights))
+        return self.native_layers[key]
+
+    def initial(self):
+        pass
+
+    def dynamic(self):
+
+        # re-calculate current model time using current pcraster timestep value
+        self.modelTime.update(self.currentTimeStep())
+
+        # runoff (from netcdf files, unit: kg m-2 s-1) - read only once for all catchments
+        if self.prefetcher != None:
+            runoff = self.prefetcher.get(self.modelTime.fulldate, self.modelTime.isLastTimeStep())
+        else:
+            if self.native_resolution:
+                runoff = vos.netcdf2NumpyCloneNative(self.input_files["netcdf_runoff"]["file_name"], \
+                                                     self.input_files["netcdf_runoff"]['variable_name'], \
+                                                     str(self.modelTime.fulldate), \
+                                                     useDoy = None, \
+                                                     cloneMapFileName = self.clone_map_file, \
+                                                     timeSlabSize = self.input_files["netcdf_runoff"].get("time_slab_size"))
+            else:
+                runoff = vos.netcdf2NumpyClone(self.input_files["netcdf_runoff"]["file_name"], \
+                                               self.input_files["netcdf_runoff"]['variable_name'], \
+                                               str(self.modelTime.fulldate), \
+                                               useDoy = None, \
+                                               cloneMapFileName = self.clone_map_file, \
+                                               timeSlabSize = self.input_files["netcdf_runoff"].get("time_slab_size"), \
+                                               regridMethod = self.regrid_method)
+        layers = self.layers
+        if self.native_resolution:
+            runoff, factor = runoff
+            layers = self.getNativeLayers(factor, runoff.shape[1])
+        runoff = runoff.ravel()
+
+        # total runoff (m3/day) within every catchment
+        number_of_catchments = len(self.station_ids)
+        runoff_total = np.zeros(number_of_catchments + 1, dtype = np.float64)
+        with instrumentation.stage("catchment: reduction"):
+            for cell_index, labels, cell_area in layers:
+                runoff_values = runoff[cell_index]
+                valid = runoff_values != vos.MV
+                if self.native_resolution:
+                    # in float64, as sparse_catchment.getRunoffTotalNative
+                    runoff_values = runoff_values[valid] * cell_area[valid] * 1000. * 86400. * -1.0
+                else:
+                    # the same float32 operations as the PCRaster maps (see sparse_catchment.getRunoffTotal)
+                    runoff_values = runoff_values[valid].astype(np.float32) * np.float32(1000.) * cell_area[valid] * \
+                                    np.float32(86400.) * np.float32(-1.0)
+                runoff_total += np.bincount(labels[valid], weights = runoff_values, minlength = number_of_catchments + 1)
+        # - rounded to float32, as the PCRaster map total
+        if not self.native_resolution: runoff_total = runoff_total.astype(np.float32)
+
+        # average runoff (mm/day) within every catchment
+        average_runoff = runoff_total[1:] / (1000. * self.catchment_area)
+
+        with instrumentation.stage("output"):
+            self.result_writer.write(self.modelTime.fulldate, average_runoff)
+            if self.modelTime.isLastTimeStep(): self.result_writer.close()
@@ -0,0 +1,370 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Benchmarks of the extraction hot path with synthetic data (no /scratch/edwin/... data needed).
+#
+# The following data are generated in a work folder:
+# - global daily netcdf runoff files at 0.5 and 0.05 arc-degree, with the latitude from north to south
+#   ("not_flipped") and from south to north ("flipped"),
+# - a clone/cell area map with the same attributes as australia_cellsize0.05deg.map,
+# - random catchment tif files (stID_*.tif) on the clone (the GDAL python bindings are needed for these), used by
+#   CalcFramework (the first one) and BatchCalcFramework (all of them).
+#
+# Every benchmark is timed a number of times (repeats); the results (per call latency and throughput) are
+# written as a JSON file, e.g.:
+#
+#   python benchmark.py --output benchmark_results.json --work-folder /dev/shm/benchmark/
+#
+# Note: a global 0.05 arc-degree field is about 100 MB (float32), so only a few days are generated (--fine-days).
+
+import os
+import sys
+import json
+import shutil
+import timeit
+import random
+import platform
+import argparse
+import datetime
+import subprocess
+
+import numpy as np
+import netCDF4 as nc
+
+import pcraster as pcr
+from pcraster.framework import DynamicFramework
+
+import virtualOS as vos
+from currTimeStep import ModelTime
+from dynamic_calc_framework import CalcFramework
+from batch_calc_framework import BatchCalcFramework
+import workspace
+
+import logging
+logger = logging.getLogger(__name__)
+
+# the clone of the project (the synthetic clone gets the same attributes)
+clone_template_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "australia_cellsize0.05deg.map")
+
+# synthetic netcdf files
+netcdf_start_date = datetime.datetime(1979, 1, 1)
+netcdf_variable   = "Runoff"
+netcdf_fill_value = 1e20
+
+def clearCaches():
+    # to start every benchmark case with empty caches (see virtualOS)
+    vos.filecache.clear()          # closes the files
+    for cache in [vos.timecache, vos.windowcache, vos.slabcache, vos.mapattrcache]: cache.clear()
+    vos.warnedtimes.clear()
+
+def timeFunction(function, repeats = 3, number = 1, setup = None):
+    # To time a function: 'number' calls for every repeat. Returns the times (seconds) per call.
+    times = []
+    for i_repeat in range(repeats):
+        if setup != None: setup()
+        start = timeit.default_timer()
+        for i_call in range(number): function()
+        times.append((timeit.default_timer() - start) / number)
+    return times
+
+def getResult(name, case, times, items_per_call = None, item_unit = None):
+    # one (JSON) benchmark result
+    result = {"name"      : name,\
+              "case"      : case,\
+              "repeats"   : len(times),\
+              "times_s"   : times,\
+              "min_s"     : min(times),\
+              "median_s"  : float(np.median(times)),\
+              "mean_s"    : float(np.mean(times))}
+    if items_per_call != None:
+        result["throughput"]      = items_per_call / min(times)
+        result["throughput_unit"] = str(item_unit) + "/s"
+    logger.info(name + " (" + case + "): " + str(result["min_s"]) + " s per call")
+    return result
+
+def makeCloneMap(clone_file):
+    # a clone (cell area) map with the same attributes as australia_cellsize0.05deg.map
+    attributes = vos.getMapAttributesALL(clone_template_file)
+    rows = int(attributes['rows']) ; cols = int(attributes['cols'])
+    pcr.setclone(rows, cols, attributes['cellsize'], attributes['xUL'], attributes['yUL'])
+    # - getCellAreaGrid returns a read-only broadcast view (one value for every row): copied into a contiguous array
+    cell_area = np.ascontiguousarray(vos.getCellAreaGrid(attributes['cellsize'], rows, cols, attributes['yUL']))
+    pcr.report(pcr.numpy2pcr(pcr.Scalar, cell_area, vos.MV), clone_file)
+    return attributes
+
+def makeNetCDFFile(nc_file, cellsize, number_of_days, flipped, seed = 0):
+    # a global daily runoff file (kg m-2 s-1) with about 30% missing values (the "oceans")
+    rows = int(round(180. / cellsize)) ; cols = int(round(360. / cellsize))
+    lat = 90. - cellsize * (np.arange(rows) + 0.5)
+    lon = -180. + cellsize * (np.arange(cols) + 0.5)
+    if flipped: lat = lat[::-1]
+
+    rootgrp = nc.Dataset(nc_file, 'w', format = 'NETCDF4')
+    rootgrp.createDimension('time', None)
+    rootgrp.createDimension('lat', rows)
+    rootgrp.createDimension('lon', cols)
+    var = rootgrp.createVariable('lat', 'f8', ('lat',)) ; var.units = 'degrees_north' ; var[:] = lat
+    var = rootgrp.createVariable('lon', 'f8', ('lon',)) ; var.units = 'degrees_east'  ; var[:] = lon
+    time = rootgrp.createVariable('time', 'f8', ('time',))
+    time.units    = 'days since ' + netcdf_start_date.strftime('%Y-%m-%d')
+    time.calendar = 'standard'
+    runoff = rootgrp.createVariable(netcdf_variable, 'f4', ('time', 'lat', 'lon'), \
+                                    fill_value = netcdf_fill_value, chunksizes = (1, rows, cols))
+    runoff.units = 'kg m-2 s-1'
+
+    random_state = np.random.RandomState(seed)
+    ocean = random_state.rand(rows, cols) < 0.3
+    for i_day in range(number_of_days):
+        values = (random_state.lognormal(size = (rows, cols)) * 1e-5).astype(np.float32)
+        values[ocean] = netcdf_fill_value
+        runoff[i_day,:,:] = values
+        time[i_day] = i_day
+    rootgrp.close()
+    return {"rows": rows, "cols": cols, "days": number_of_days}
+
+def makeCatchmentTif(tif_file, attributes, seed = 0):
+    # a random (elliptic) catchment on the clone: 1 within the catchment, 0 (no data) outside
+    random_state = np.random.RandomState(seed)
+    rows = int(attributes['rows']) ; cols = int(attributes['cols'])
+    center_row = random_state.randint(rows // 4, 3 * rows // 4)
+    center_col = random_state.randint(cols // 4, 3 * cols // 4)
+    radius_row = random_state.randint(10, rows // 8)
+    radius_col = random_state.randint(10, cols // 8)
+    row, col = np.ogrid[0:rows, 0:cols]
+    catchment = (((row - center_row) / float(radius_row))**2 + ((col - center_col) / float(radius_col))**2 <= 1.0).astype(np.int32)
+
+    driver = vos.gdal.GetDriverByName('GTiff')
+    dataset = driver.Create(tif_file, cols, rows, 1, vos.gdal.GDT_Int32)
+    dataset.SetGeoTransform((attributes['xUL'], attributes['cellsize'], 0.0, attributes['yUL'], 0.0, -attributes['cellsize']))
+    dataset.SetProjection('GEOGCS["WGS 84",DATUM["WGS_1984",SPHEROID["WGS 84",6378137,298.257223563]],PRIMEM["Greenwich",0],UNIT["degree",0.0174532925199433]]')
+    band = dataset.GetRasterBand(1)
+    band.SetNoDataValue(0)
+    band.WriteArray(catchment)
+    dataset = None
+    return int(catchment.sum())
+
+def makeCatchmentTifs(tif_folder, attributes, number_of_catchments):
+    # random catchments (see makeCatchmentTif), as the files stID_000001.tif, stID_000002.tif, ... in tif_folder
+    vos.makeDir(tif_folder)
+    tif_files = []
+    for i_catchment in range(number_of_catchments):
+        tif_files.append(os.path.join(tif_folder, "stID_%06i.tif" %(i_catchment + 1)))
+        makeCatchmentTif(tif_files[-1], attributes, seed = i_catchment)
+    return tif_files
+
+def benchmarkMapAttributes(clone_file, repeats):
+    results = []
+    times = timeFunction(lambda: vos.getMapAttributesALL(clone_file), repeats = repeats, setup = clearCaches)
+    results.append(getResult("getMapAttributesALL", "uncached", times))
+    vos.getMapAttributesALL(clone_file)
+    times = timeFunction(lambda: vos.getMapAttributesALL(clone_file), repeats = repeats, number = 100)
+    results.append(getResult("getMapAttributesALL", "cached", times))
+    return results
+
+def benchmarkReadPCRmapClone(clone_file, tmp_folder, repeats):
+    pcr.setclone(clone_file)
+    attributes = vos.getMapAttributesALL(clone_file)
+    cells = attributes['rows'] * attributes['cols']
+    times = timeFunction(lambda: vos.readPCRmapClone(clone_file, clone_file, tmp_folder), repeats = repeats)
+    return [getResult("readPCRmapClone", "same_clone", times, cells, "cells")]
+
+def benchmarkNetCDFReader(nc_files, clone_file, number_of_steps, repeats):
+    results = []
+    pcr.setclone(clone_file)
+    for case, nc_file in sorted(nc_files.items()):
+        dataset = nc.Dataset(nc_file)
+        number_of_days = len(dataset.variables['time'])
+        dataset.close()
+        dates = [netcdf_start_date + datetime.timedelta(days = i_day) for i_day in range(min(number_of_steps, number_of_days))]
+        for time_slab_size in [None, "auto"]:
+            def readAll():
+                for date in dates:
+                    vos.netcdf2PCRobjClone(nc_file, netcdf_variable, date.strftime('%Y-%m-%d'), \
+                                           useDoy = None, \
+                                           cloneMapFileName = clone_file, \
+                                           timeSlabSize = time_slab_size)
+            times = timeFunction(readAll, repeats = repeats, setup = clearCaches)
+            times = [t / len(dates) for t in times]
+            results.append(getResult("netcdf2PCRobjClone", case + "_slab_" + str(time_slab_size), times, 1, "steps"))
+    clearCaches()
+    return results
+
+def benchmarkRegridding(attributes, repeats):
+    # 0.5 to 0.05 arc-degree (factor 10) on the clone extent
+    results = []
+    factor = 10
+    rows = int(attributes['rows']) // factor ; cols = int(attributes['cols']) // factor
+    coarse = np.random.RandomState(0).rand(rows, cols)
+    fine_cells = rows * cols * factor * factor
+    times = timeFunction(lambda: vos.regridData2FinerGrid(factor, coarse, vos.MV), repeats = repeats)
+    results.append(getResult("regridData2FinerGrid", "factor_" + str(factor), times, fine_cells, "cells"))
+
+    fine = vos.regridData2FinerGrid(factor, coarse, vos.MV).copy()
+    fine[np.random.RandomState(1).rand(*fine.shape) < 0.3] = vos.MV
+    for mode in ['average', 'sum', 'min', 'max']:
+        times = timeFunction(lambda: vos.regridToCoarse(fine, factor, mode, vos.MV), repeats = repeats)
+        results.append(getResult("regridToCoarse", mode + "_factor_" + str(factor), times, fine_cells, "cells"))
+    return results
+
+def benchmarkWaterAbstractionAndAllocation(attributes, repeats, zone_size = 50):
+    # waterAbstractionAndAllocation (pcr.areatotal) and waterAbstractionAndAllocationNumpy (np.bincount) on the 
+    # clone (national) grid with square allocation zones of zone_size x zone_size cells; the results are cross-checked
+    rows = int(attributes['rows']) ; cols = int(attributes['cols'])
+    random_state = np.random.RandomState(0)
+    zone_ids = (np.arange(rows)[:,np.newaxis] // zone_size) * (cols // zone_size + 1) + np.arange(cols)[np.newaxis,:] // zone_size + 1
+    allocation_zones = pcr.numpy2pcr(pcr.Nominal, zone_ids.astype(np.int32), -1)
+    water_demand     = random_state.lognormal(8., 2., (rows, cols)).astype(np.float32)
+    available_water  = random_state.lognormal(9., 3., (rows, cols)).astype(np.float32)
+    water_demand[random_state.rand(rows, cols) < 0.3] = vos.MV                  # e.g. the "oceans"
+    water_demand_volume    = pcr.numpy2pcr(pcr.Scalar, water_demand, vos.MV)
+    available_water_volume = pcr.numpy2pcr(pcr.Scalar, available_water, vos.MV)
+    zone_area = pcr.areatotal(pcr.spatial(pcr.scalar(1e6)), allocation_zones)
+
+    results = []
+    outputs = {}
+    for name, function in [("waterAbstractionAndAllocation"     , vos.waterAbstractionAndAllocation), \
+                           ("waterAbstractionAndAllocationNumpy", vos.waterAbstractionAndAllocationNumpy)]:
+        def allocate(): outputs[name] = function(water_demand_volume, available_water_volume, allocation_zones, zone_area = zone_area)
+        times = timeFunction(allocate, repeats = repeats)
+        results.append(getResult(name, str(rows) + "x" + str(cols) + "_zones_" + str(zone_size), times, rows * cols, "cells"))
+
+    # cross-check: the maximum differences (m3) of the abstraction and allocation volumes (float32 rounding in PCRaster)
+    for i_output, output_name in enumerate(["abstraction", "allocation"]):
+        reference = pcr.pcr2numpy(outputs["waterAbstractionAndAllocation"][i_output], np.nan)
+        numpy_result = pcr.pcr2numpy(outputs["waterAbstractionAndAllocationNumpy"][i_output], np.nan)
+        both = ~np.isnan(reference) & ~np.isnan(numpy_result)
+        difference = np.abs(reference[both].astype(np.float64) - numpy_result[both])
+        results[-1]["max_abs_difference_" + output_name + "_m3"] = float(difference.max()) if difference.size > 0 else 0.0
+        results[-1]["max_rel_difference_" + output_name] = float((difference / np.maximum(1.0, np.abs(reference[both]))).max()) if difference.size > 0 else 0.0
+        results[-1]["missing_values_mismatch_" + output_name] = int(np.sum(np.isnan(reference) != np.isnan(numpy_result)))
+    results[-1]["speedup"] = results[0]["min_s"] / results[-1]["min_s"]
+    logger.info('waterAbstractionAndAllocationNumpy: speedup ' + str(results[-1]["speedup"]))
+    return results
+
+def timeDynamicFramework(model_class, catchment_input_files, nc_file, clone_file, work_folder, number_of_days, repeats):
+    # To run a full year (or the period of the netcdf file) with the DynamicFramework. Returns the setup and total 
+    # times (seconds) of every repeat. catchment_input_files: the tif file(s) of the model (e.g. "tif_catchment_file").
+    results = []
+    end_date = netcdf_start_date + datetime.timedelta(days = number_of_days - 1)
+    for i_repeat in range(repeats):
+        clearCaches()
+        output_files = {}
+        output_files['folder']            = os.path.join(work_folder, "calc_framework_output")
+        output_files['output_txt_file']   = os.path.join(output_files['folder'], "benchmark.txt")
+        output_files['output_format']     = "csv"
+        if os.path.isdir(output_files['folder']): shutil.rmtree(output_files['folder'])
+        os.makedirs(output_files['folder'])
+        output_files['tmp_output_folder'] = workspace.createWorkspace(prefix = "benchmark_", fallbackFolder = output_files['folder'])
+
+        input_files = {}
+        input_files.update(catchment_input_files)
+        input_files["cellarea_0.05deg_file"]          = clone_file
+        input_files["catchment_cache_folder"]         = None
+        input_files["netcdf_runoff"]                  = {}
+        input_files["netcdf_runoff"]["file_name"]     = nc_file
+        input_files["netcdf_runoff"]["variable_name"] = netcdf_variable
+        input_files["netcdf_runoff"]["time_slab_size"] = "auto"
+        input_files["netcdf_runoff"]["prefetch_depth"] = None
+
+        modelTime = ModelTime()
+        modelTime.getStartEndTimeSteps(netcdf_start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d'), showNumberOfTimeSteps = False)
+
+        start = timeit.default_timer()
+        calculationModel = model_class(modelTime, input_files, output_files)
+        setup_time = timeit.default_timer() - start
+        dynamic_framework = DynamicFramework(calculationModel, modelTime.nrOfTimeSteps)
+        dynamic_framework.setQuiet(True)
+        dynamic_framework.run()
+        total_time = timeit.default_timer() - start
+        workspace.removeWorkspace(output_files['tmp_output_folder'])
+
+        results.append((setup_time, total_time))
+    clearCaches()
+    return results
+
+def benchmarkCalcFramework(nc_file, clone_file, tif_file, work_folder, number_of_days, repeats):
+    # a single catchment with CalcFramework
+    results = timeDynamicFramework(CalcFramework, {"tif_catchment_file": tif_file}, nc_file, clone_file, work_folder, number_of_days, repeats)
+    return [getResult("CalcFramework", "setup", [r[0] for r in results]), \
+            getResult("CalcFramework", str(number_of_days) + "_days", [r[1] for r in results], number_of_days, "steps")]
+
+def benchmarkBatchCalcFramework(nc_file, clone_file, tif_files, work_folder, number_of_days, repeats):
+    # all catchments in a single pass with BatchCalcFramework (throughput: catchment days)
+    results = timeDynamicFramework(BatchCalcFramework, {"tif_catchment_files": tif_files}, nc_file, clone_file, work_folder, number_of_days, repeats)
+    case = str(len(tif_files)) + "_catchments_"
+    return [getResult("BatchCalcFramework", case + "setup", [r[0] for r in results]), \
+            getResult("BatchCalcFramework", case + str(number_of_days) + "_days", [r[1] for r in results], number_of_days * len(tif_files), "catchment_days")]
+
+def getMetadata(arguments):
+    metadata = {"date"     : datetime.datetime.now().isoformat(),\
+                "python"   : platform.python_version(),\
+                "numpy"    : np.__version__,\
+                "netCDF4"  : nc.__version__,\
+                "platform" : platform.platform(),\
+                "gdal"     : vos.gdal.__version__ if vos.gdal != None else None,\
+                "arguments": vars(arguments)}
+    try:
+        metadata["git_commit"] = subprocess.check_output(["git", "rev-parse", "HEAD"], \
+                                                         cwd = os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except Exception:
+        metadata["git_commit"] = None
+    return metadata
+
+def main():
+
+    parser = argparse.ArgumentParser(description = "Benchmarks of the extraction hot path with synthetic data.")
+    parser.add_argument("--output",      default = "benchmark_results.json", help = "JSON output file")
+    parser.add_argument("--work-folder", default = "/tmp/catchment_benchmark/", help = "folder for the synthetic data")
+    parser.add_argument("--days",        default = 365, type = int, help = "number of days of the 0.5 arc-degree files")
+    parser.add_argument("--fine-days",   default = 3,   type = int, help = "number of days of the 0.05 arc-degree files")
+    parser.add_argument("--steps",       default = 30,  type = int, help = "number of time steps read in the netcdf benchmarks")
+    parser.add_argument("--repeats",     default = 3,   type = int, help = "number of repeats of every benchmark")
+    parser.add_argument("--catchments",  default = 5,   type = int, help = "number of catchment tif files (BatchCalcFramework)")
+    parser.add_argument("--keep-data",   action = "store_true", help = "do not remove the synthetic data")
+    arguments = parser.parse_args()
+
+    logging.basicConfig(level = logging.INFO, format = '%(asctime)s %(name)s %(levelname)s %(message)s')
+    random.seed(0)
+
+    work_folder = os.path.abspath(arguments.work_folder)
+    tmp_folder  = os.path.join(work_folder, "tmp")
+    vos.makeDir(work_folder) ; vos.makeDir(tmp_folder)
+    output_file = os.path.abspath(arguments.output)
+
+    # synthetic data
+    logger.info('Generating the synthetic data in: ' + work_folder)
+    clone_file = os.path.join(work_folder, "clone_cellsize0.05deg.map")
+    attributes = makeCloneMap(clone_file)
+    nc_files = {}
+    for cellsize, number_of_days in [(0.5, arguments.days), (0.05, arguments.fine_days)]:
+        for flipped in [False, True]:
+            case = str(cellsize) + "deg_" + ("flipped" if flipped else "not_flipped")
+            nc_files[case] = os.path.join(work_folder, "runoff_" + case + ".nc")
+            makeNetCDFFile(nc_files[case], cellsize, number_of_days, flipped)
+    tif_files = []
+    if vos.gdal != None:
+        tif_files = makeCatchmentTifs(os.path.join(work_folder, "catchments"), attributes, max(1, arguments.catchments))
+
+    # benchmarks
+    results = []
+    results += benchmarkMapAttributes(clone_file, arguments.repeats)
+    results += benchmarkReadPCRmapClone(clone_file, tmp_folder, arguments.repeats)
+    results += benchmarkNetCDFReader(nc_files, clone_file, arguments.steps, arguments.repeats)
+    results += benchmarkRegridding(attributes, arguments.repeats)
+    results += benchmarkWaterAbstractionAndAllocation(attributes, arguments.repeats)
+    skipped = []
+    if len(tif_files) > 0:
+        results += benchmarkCalcFramework(nc_files["0.5deg_not_flipped"], clone_file, tif_files[0], work_folder, arguments.days, arguments.repeats)
+        results += benchmarkBatchCalcFramework(nc_files["0.5deg_not_flipped"], clone_file, tif_files, work_folder, arguments.days, arguments.repeats)
+    else:
+        for name in ["CalcFramework", "BatchCalcFramework"]:
+            skipped.append({"name": name, "reason": "the GDAL python bindings are needed to generate the catchment tif files"})
+
+    with open(output_file, 'w') as json_file:
+        json.dump({"metadata": getMetadata(arguments), "results": results, "skipped": skipped}, json_file, indent = 2)
+    logger.info('The benchmark results are written to: ' + output_file)
+
+    if not arguments.keep_data: shutil.rmtree(work_folder)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import glob
+import hashlib
+
+import numpy as np
+
+import virtualOS as vos
+
+import logging
+logger = logging.getLogger(__name__)
+
+# version of the cached content (increase it if the content/format changes, to invalidate old cache files)
+CACHE_VERSION = 1
+
+# file hashes (key: file path, modification time and size), e.g. the clone map is hashed only once per run
+filehashcache = dict()
+
+def getFileHash(fileName, blockSize = 1024 * 1024):
+    # sha1 of the content of a file
+    fileStat = os.stat(fileName)
+    hashKey  = (os.path.abspath(fileName), fileStat.st_mtime, fileStat.st_size)
+    if hashKey in filehashcache: return filehashcache[hashKey]
+    sha1 = hashlib.sha1()
+    with open(fileName, 'rb') as f:
+        while True:
+            block = f.read(blockSize)
+            if not block: break
+            sha1.update(block)
+    filehashcache[hashKey] = sha1.hexdigest()
+    return filehashcache[hashKey]
+
+def getCacheKey(tif_catchment_file, clone_map_file, resampling_method = "near", cell_area_source = "map"):
+    # The key is based on the content of the catchment tif file, the attributes (and content) of the clone map
+    # (which is also the cell area map), the resampling method and the source of the cell areas (see
+    # sparse_catchment.readCellArea).
+    cloneAttributes = vos.getMapAttributesALL(clone_map_file)
+    sha1 = hashlib.sha1()
+    sha1.update(str(CACHE_VERSION).encode('utf-8'))
+    sha1.update(getFileHash(tif_catchment_file).encode('utf-8'))
+    sha1.update(getFileHash(clone_map_file).encode('utf-8'))
+    for attribute in sorted(cloneAttributes.keys()):
+        sha1.update((attribute + "=" + repr(cloneAttributes[attribute])).encode('utf-8'))
+    sha1.update(str(resampling_method).encode('utf-8'))
+    if cell_area_source != "map": sha1.update(("cell_area_source=" + str(cell_area_source)).encode('utf-8'))
+    return sha1.hexdigest()
+
+def getCacheFileName(cache_folder, tif_catchment_file, cache_key):
+    name = os.path.splitext(os.path.basename(tif_catchment_file))[0]
+    return os.path.join(cache_folder, name + "_" + cache_key + ".npz")
+
+def loadPreparedCatchment(cache_folder, tif_catchment_file, clone_map_file, resampling_method = "near", cell_area_source = "map"):
+    # Returns the prepared catchment (see savePreparedCatchment) or None if it is not (or no longer) in the cache.
+    if cache_folder == None: return None
+    cache_key  = getCacheKey(tif_catchment_file, clone_map_file, resampling_method, cell_area_source)
+    cache_file = getCacheFileName(cache_folder, tif_catchment_file, cache_key)
+    if not os.path.isfile(cache_file):
+        logger.debug('The catchment '+str(tif_catchment_file)+' is not in the cache.')
+        return None
+    try:
+        cached = np.load(cache_file)
+        prepared_catchment = {}
+        for variable in cached.files: prepared_catchment[variable] = cached[variable]
+        cached.close()
+    except Exception as error:
+        logger.warning('The cache file '+str(cache_file)+' cannot be read ('+str(error)+'). It is ignored.')
+        return None
+    prepared_catchment['catchment_area'] = float(prepared_catchment['catchment_area'])
+    prepared_catchment['shape'] = tuple(int(n) for n in prepared_catchment['shape'])
+    logger.info('The prepared catchment is read from the cache file: '+str(cache_file))
+    return prepared_catchment
+
+def prepareCatchment(landmask, cell_area):
+    # The prepared catchment (as saved in the cache):
+    # - landmask_index  : flat indexes (int32) of the catchment cells on the clone
+    # - active_index    : flat indexes (int32) of the catchment cells that have cell area values
+    # - active_cell_area: cell areas (float32, m2) of the active cells, i.e. the weights
+    # - catchment_area  : catchment area (m2), the total of the float32 cell areas (as the PCRaster map total)
+    # - shape           : shape of the clone
+    #
+    # landmask: boolean numpy array (clone shape); cell_area: numpy array with MV for missing values
+    shape     = tuple(int(n) for n in np.shape(landmask))
+    landmask  = np.asarray(landmask, dtype = bool).ravel()
+    cell_area = np.asarray(cell_area).ravel()
+    active    = landmask & (cell_area != cell_area.dtype.type(vos.MV))
+    prepared_catchment = {}
+    prepared_catchment['landmask_index']   = np.flatnonzero(landmask).astype(np.int32)
+    prepared_catchment['active_index']     = np.flatnonzero(active).astype(np.int32)
+    prepared_catchment['active_cell_area'] = cell_area[active].astype(np.float32)
+    prepared_catchment['catchment_area']   = float(np.float32(np.sum(prepared_catchment['active_cell_area'], dtype = np.float64)))
+    prepared_catchment['shape']            = shape
+    return prepared_catchment
+
+def savePreparedCatchment(cache_folder, tif_catchment_file, clone_map_file, prepared_catchment, resampling_method = "near", cell_area_source = "map"):
+    # To save a prepared catchment (see prepareCatchment).
+    # Older cache files of the same catchment (based on other tif/clone/method) are removed.
+    if cache_folder == None: return
+    vos.makeDir(cache_folder)
+    cache_key  = getCacheKey(tif_catchment_file, clone_map_file, resampling_method, cell_area_source)
+    cache_file = getCacheFileName(cache_folder, tif_catchment_file, cache_key)
+
+    # remove stale cache files of this catchment
+    for stale_file in glob.glob(getCacheFileName(cache_folder, tif_catchment_file, "*")):
+        if stale_file != cache_file and not stale_file.endswith(".tmp.npz"):
+            logger.info('Remove the stale cache file: '+str(stale_file))
+            os.remove(stale_file)
+
+    # write to a temporary file first (to avoid incomplete files if several runs write the same catchment)
+    tmp_file = cache_file + "." + vos.get_random_word(8) + ".tmp.npz"
+    np.savez(tmp_file, \
+             landmask_index   = prepared_catchment['landmask_index'], \
+             active_index     = prepared_catchment['active_index'], \
+             active_cell_area = prepared_catchment['active_cell_area'], \
+             catchment_area   = np.float64(prepared_catchment['catchment_area']), \
+             shape            = np.array(prepared_catchment['shape'], dtype = np.int64))
+    os.rename(tmp_file, cache_file)
+    logger.info('The prepared catchment is saved to the cache file: '+str(cache_file))
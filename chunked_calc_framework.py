@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import datetime
+import multiprocessing
+
+import virtualOS as vos
+from currTimeStep import ModelTime
+from dynamic_calc_framework import CalcFramework
+from matrix_calc_framework import getRunoffTotals
+import instrumentation
+
+import logging
+logger = logging.getLogger(__name__)
+
+def getDateChunks(startDate, endDate, chunk = "year"):
+    # To split the period between startDate and endDate (strings: YYYY-MM-DD) into chunks (start and end dates):
+    # chunk = "year" (calendar years, i.e. the yearly netcdf files, see vos.getNCFileName) or a number of days.
+    def dateString(date): return '%04i-%02i-%02i' %(date.year, date.month, date.day)
+    startDate = vos.getDateTime(startDate).date()
+    endDate   = vos.getDateTime(endDate).date()
+    chunks = []
+    chunkStart = startDate
+    while chunkStart <= endDate:
+        if chunk == "year":
+            chunkEnd = datetime.date(chunkStart.year, 12, 31)
+        else:
+            chunkEnd = chunkStart + datetime.timedelta(days = max(1, int(chunk)) - 1)
+        chunkEnd = min(chunkEnd, endDate)
+        chunks.append((dateString(chunkStart), dateString(chunkEnd)))
+        chunkStart = chunkEnd + datetime.timedelta(days = 1)
+    return chunks
+
+def _runChunk(task):
+    # To calculate the total runoff (m3/day) within the catchment for the dates of a chunk, with its own ModelTime.
+    catchment, netcdf_runoff, clone_map_file, chunk_start, chunk_end, time_block_size, native_resolution, regrid_method = task
+    modelTime = ModelTime()
+    modelTime.getStartEndTimeSteps(chunk_start, chunk_end, showNumberOfTimeSteps = False)
+    all_dates = [] ; runoff_totals = []
+    dates = []
+    for time_step in range(1, modelTime.nrOfTimeSteps + 1):
+        modelTime.update(time_step)
+        dates.append(str(modelTime.fulldate))
+        if len(dates) == time_block_size or modelTime.isLastTimeStep():
+            runoff_totals.extend(float(total) for total in getRunoffTotals(catchment, netcdf_runoff, clone_map_file, dates, \
+                                                                           native_resolution, regrid_method))
+            all_dates.extend(dates)
+            dates = []
+    return all_dates, runoff_totals
+
+class ChunkedCalcFramework(CalcFramework):
+    # Catchment averages of a single catchment, with the period split into chunks (e.g. years, see getDateChunks)
+    # that are calculated in parallel by a pool of worker processes.
+    #
+    # The catchment is prepared once (as in CalcFramework) and sent to the workers. Every chunk has its own
+    # ModelTime and is read and reduced in blocks of time steps (as in MatrixCalcFramework). The results of the
+    # chunks are written in the order of the dates (see result_writers), whichever worker finishes first.
+
+    def __init__(self, modelTime, \
+                       input_files, \
+                       output_files, \
+                       chunk = "year", \
+                       number_of_workers = None):
+        # the chunks are read by the workers, a prefetcher is not used (so no netcdf files are opened before the 
+        # workers are started)
+        CalcFramework.__init__(self, modelTime, \
+                                     input_files, \
+                                     output_files, \
+                                     use_prefetcher = False)
+
+        self.chunks = getDateChunks(self.modelTime.startTime, self.modelTime.endTime, chunk)
+        if number_of_workers == None: number_of_workers = multiprocessing.cpu_count()
+        self.number_of_workers = max(1, min(int(number_of_workers), len(self.chunks)))
+        logger.info('Number of chunks: ' + str(len(self.chunks)) + ' ; number of worker processes: ' + str(self.number_of_workers))
+
+        # number of time steps read and reduced at once (within a chunk)
+        self.time_block_size = vos.getTimeBlockSize(self.input_files["netcdf_runoff"].get("time_slab_size"))
+
+    def run(self):
+
+        tasks = [(self.catchment, self.input_files["netcdf_runoff"], self.clone_map_file, chunk_start, chunk_end, \
+                  self.time_block_size, self.native_resolution, self.regrid_method) for chunk_start, chunk_end in self.chunks]
+
+        pool = multiprocessing.Pool(self.number_of_workers)
+        try:
+            # imap: the results are returned in the order of the chunks
+            for dates, runoff_totals in pool.imap(_runChunk, tasks):
+                with instrumentation.stage("output"):
+                    for date, total in zip(dates, runoff_totals):
+
+                        # average runoff (mm/day) within the catchment
+                        average_runoff_within_the_catchment = total / (1000. * self.catchment_area)
+
+                        self.result_writer.write(date, average_runoff_within_the_catchment)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        self.result_writer.close()
@@ -94,6 +94,14 @@ class ModelTime(object):
     def fulldate(self):
         return self._fulldate
 
+    def getAllFullDates(self):
+        # all dates between startTime and endTime (same format as fulldate)
+        dates = []
+        for i in range(self.nrOfTimeSteps):
+            date = self._startTime + datetime.timedelta(days=i)
+            dates.append('%04i-%02i-%02i' %(date.year, date.month, date.day))
+        return dates
+
     def update(self,timeStepPCR):
         self._timeStepPCR = timeStepPCR
         self._currTime = self._startTime + datetime.timedelta(days=1 * (timeStepPCR - 1))
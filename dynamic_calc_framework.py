@@ -10,6 +10,10 @@ import pcraster as pcr
 from pcraster.framework import DynamicModel
 
 import virtualOS as vos
+from netcdf_prefetcher import startPrefetcher
+from result_writers import getResultWriter
+from sparse_catchment import getSparseCatchment, readCellArea
+import instrumentation
 
 import logging
 logger = logging.getLogger(__name__)
@@ -18,15 +22,13 @@ class CalcFramework(DynamicModel):
 
     def __init__(self, modelTime, \
                        input_files, \
-                       output_files):
+                       output_files, \
+                       use_prefetcher = True):
         DynamicModel.__init__(self)
         
         self.input_files  = input_files
         self.output_files = output_files
         
-        # txt output file
-        self.txt_out_file = open(self.output_files['output_txt_file'], 'w')
-        
         # use cell area as the clone map
         self.clone_map_file = self.input_files["cellarea_0.05deg_file"]
         pcr.setclone( self.clone_map_file)
@@ -35,45 +37,53 @@ class CalcFramework(DynamicModel):
         self.x_max = pcr.clone().west()  + pcr.clone().nrCols() * pcr.clone().cellSize() 
         self.y_max = pcr.clone().north()
 
-        # change working directory to the temporary output folder
-        os.chdir(self.output_files['tmp_output_folder'])
-        
-        print_to_screen = 'The input catchment tif file : ' + str(self.input_files["tif_catchment_file"]) + " \n" 
-        print(print_to_screen)
-        # - also write to a file
-        self.txt_out_file.write(print_to_screen)
-
-        # resample tif to the extent of the clone  
-        input_tif_file     = self.input_files["tif_catchment_file"]
-        corner_coordinates = str(self.x_min) + " " +\
-                             str(self.y_min) + " " +\
-                             str(self.x_max) + " " +\
-                             str(self.y_max) + " "
-        cmd = 'gdalwarp -te ' + corner_coordinates + input_tif_file + " tmp.tif" 
-        print(cmd); os.system(cmd)
-        # - convert to a pcraster map 
-        cmd = 'pcrcalc catchment.map = "nominal(tmp.tif)"'
-        print(cmd); os.system(cmd)
-        # - make sure that it has a good projection system
-        cmd = 'mapattr -s -P yb2t catchment.map'
-        # - set it as the catchment and landmask maps
-        self.catchment = pcr.readmap("catchment.map")
-        self.landmask  = pcr.defined(self.catchment)
+        # the working directory is not changed: temporary files are written to output_files['tmp_output_folder']
+        # (a unique workspace for every run, see workspace) with absolute paths
         
-        # calculate catchment area (m2)
-        self.cell_area      = vos.readPCRmapClone(self.input_files['cellarea_0.05deg_file'], self.clone_map_file, self.output_files['tmp_output_folder'])
-        catchment_area_map  = pcr.ifthen(self.landmask, self.cell_area)
-        #~ pcr.aguila(catchment_area_map)
-        self.catchment_area = vos.getMapTotal(catchment_area_map)       # unit: m2
+        info_input_file = 'The input catchment tif file : ' + str(self.input_files["tif_catchment_file"]) + " \n" 
+
+        # cell area (m2)
+        cell_area = readCellArea(self.input_files, self.clone_map_file, self.output_files['tmp_output_folder'])
+
+        # the catchment as its active cells and cell areas (see sparse_catchment; from the cache if available)
+        self.catchment = getSparseCatchment(self.input_files["tif_catchment_file"], \
+                                            self.clone_map_file, \
+                                            cell_area, \
+                                            self.output_files['tmp_output_folder'], \
+                                            cache_folder = self.input_files.get("catchment_cache_folder"), \
+                                            station_id = vos.getStationID(self.input_files["tif_catchment_file"]), \
+                                            cell_area_source = self.input_files.get("cell_area_source", "map"))
+        self.catchment_area = self.catchment.catchment_area       # unit: m2
         
-        print_to_screen = 'The catchment area is (m2): ' + str(self.catchment_area) + " \n"
-        print(print_to_screen)
-        # - also write to a file
-        self.txt_out_file.write(print_to_screen)
+        # output file (see result_writers)
+        self.result_writer = getResultWriter(self.output_files, \
+                                             [self.catchment.station_id], \
+                                             [self.catchment_area])
+        self.result_writer.write_info(info_input_file)
+        self.result_writer.write_info('The catchment area is (m2): ' + str(self.catchment_area) + " \n")
+
+        # reduce the runoff at the native resolution of the netcdf file (see sparse_catchment.getCoarseWeights)
+        self.native_resolution = self.input_files["netcdf_runoff"].get("native_resolution", False)
+
+        # resample the runoff fields with a cached sparse regridding operator (None: replicate the input cells)
+        self.regrid_method = self.input_files["netcdf_runoff"].get("regrid_method")
 
         # time variable/object
         self.modelTime = modelTime
         
+        # optional: read the runoff of the following time steps in a background thread
+        # - use_prefetcher = False: for engines that read the runoff otherwise (the thread is never started)
+        self.prefetcher = None
+        if use_prefetcher: self.startPrefetcher()
+        
+    def startPrefetcher(self):
+        # starts the prefetcher (see netcdf_prefetcher) if input_files["netcdf_runoff"]["prefetch_depth"] is given
+        self.prefetcher = startPrefetcher(self.input_files["netcdf_runoff"], \
+                                          self.modelTime.getAllFullDates(), \
+                                          cloneMapFileName = self.clone_map_file, \
+                                          nativeResolution = self.native_resolution, \
+                                          regridMethod = self.regrid_method)
+        
     def initial(self): 
         pass
 
@@ -83,23 +93,48 @@ class CalcFramework(DynamicModel):
         self.modelTime.update(self.currentTimeStep())
 
         # runoff (from netcdf files, unit: kg m-2 s-1)
-        self.runoff = vos.netcdf2PCRobjClone(self.input_files["netcdf_runoff"]["file_name"], \
-                                             self.input_files["netcdf_runoff"]['variable_name'], \
-                                             str(self.modelTime.fulldate), \
-                                             useDoy = None, \
-                                             cloneMapFileName = self.clone_map_file)
-        # - use runoff value only within the catchment 
-        self.runoff = pcr.ifthen(self.landmask, self.runoff)
-        
-        # convert runoff to m3/day and direction 
-        self.runoff = self.runoff * 1000. * self.cell_area * 86400. * -1.0
+        if self.native_resolution:
+            self.dynamicNative()
+            return
+        if self.prefetcher != None:
+            runoff = self.prefetcher.get(self.modelTime.fulldate, self.modelTime.isLastTimeStep())
+        else:
+            runoff = vos.netcdf2NumpyClone(self.input_files["netcdf_runoff"]["file_name"], \
+                                           self.input_files["netcdf_runoff"]['variable_name'], \
+                                           str(self.modelTime.fulldate), \
+                                           useDoy = None, \
+                                           cloneMapFileName = self.clone_map_file, \
+                                           timeSlabSize = self.input_files["netcdf_runoff"].get("time_slab_size"), \
+                                           regridMethod = self.regrid_method)
         
         # average runoff (mm/day) within the catchment 
-        average_runoff_within_the_catchment =  vos.getMapTotal(self.runoff) / (1000. * self.catchment_area)
+        # - only the active cells are used; runoff is converted to m3/day and direction (see sparse_catchment)
+        average_runoff_within_the_catchment = self.catchment.getAverageRunoff(runoff)
+        
+        # output (written in blocks, see result_writers)
+        with instrumentation.stage("output"):
+            self.result_writer.write(self.modelTime.fulldate, average_runoff_within_the_catchment)
+            if self.modelTime.isLastTimeStep(): self.result_writer.close()
+
         
-        print_to_screen = 'Average runoff within the catchment (mm/day) for the date '  + str(self.modelTime.fulldate) + " : " + str(average_runoff_within_the_catchment) + " \n"
-        print(print_to_screen)
-        # - also write to a file
-        self.txt_out_file.write(print_to_screen)
 
+    def dynamicNative(self):
+        
+        # runoff (from netcdf files, unit: kg m-2 s-1) at the native resolution (without resampling to the clone)
+        if self.prefetcher != None:
+            runoff, factor = self.prefetcher.get(self.modelTime.fulldate, self.modelTime.isLastTimeStep())
+        else:
+            runoff, factor = vos.netcdf2NumpyCloneNative(self.input_files["netcdf_runoff"]["file_name"], \
+                                                         self.input_files["netcdf_runoff"]['variable_name'], \
+                                                         str(self.modelTime.fulldate), \
+                                                         useDoy = None, \
+                                                         cloneMapFileName = self.clone_map_file, \
+                                                         timeSlabSize = self.input_files["netcdf_runoff"].get("time_slab_size"))
+        
+        # average runoff (mm/day) within the catchment (with the coarse weights, see sparse_catchment)
+        average_runoff_within_the_catchment = float(self.catchment.getRunoffTotalNative(runoff, factor)) / (1000. * self.catchment_area)
         
+        # output (written in blocks, see result_writers)
+        with instrumentation.stage("output"):
+            self.result_writer.write(self.modelTime.fulldate, average_runoff_within_the_catchment)
+            if self.modelTime.isLastTimeStep(): self.result_writer.close()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Lightweight instrumentation: wall time and number of calls of every stage, and counters (e.g. bytes read from
+# netcdf files, file cache hits/misses, subprocess launches).
+#
+# It is disabled by default. When disabled, stage() returns a shared no-op context manager and count() returns
+# immediately, so the instrumented code runs (almost) at full speed. Usage:
+#
+#   instrumentation.enable()
+#   with instrumentation.stage("netcdf: read"): ...
+#   instrumentation.count("netcdf bytes read: " + ncFile, data.nbytes)
+#   ...
+#   instrumentation.printSummary() ; instrumentation.writeReport("instrumentation.json")
+
+import json
+import timeit
+import threading
+
+import logging
+logger = logging.getLogger(__name__)
+
+enabled = False
+
+# stage name: [number of calls, wall time (seconds)]
+stages = dict()
+# counter name: value
+counters = dict()
+
+# stages and counters may be updated from several threads (e.g. the netcdf prefetcher)
+_lock = threading.Lock()
+
+def enable(flag = True):
+    global enabled
+    enabled = bool(flag)
+
+def reset():
+    stages.clear()
+    counters.clear()
+
+class _Stage(object):
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = timeit.default_timer()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        elapsed = timeit.default_timer() - self.start
+        with _lock:
+            stage_values = stages.get(self.name)
+            if stage_values == None:
+                stages[self.name] = [1, elapsed]
+            else:
+                stage_values[0] += 1
+                stage_values[1] += elapsed
+        return False
+
+class _NoStage(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_no_stage = _NoStage()
+
+def stage(name):
+    # context manager measuring the wall time of a stage
+    if not enabled: return _no_stage
+    return _Stage(name)
+
+def count(name, value = 1):
+    if not enabled: return
+    with _lock:
+        counters[name] = counters.get(name, 0) + value
+
+def getReport():
+    report = {"stages"  : {},\
+              "counters": dict(counters)}
+    for name, (calls, seconds) in stages.items():
+        report["stages"][name] = {"calls"        : calls,\
+                                  "seconds"      : seconds,\
+                                  "mean_seconds" : seconds / calls}
+    return report
+
+def printSummary():
+    # a table of the stages (sorted by the total wall time) and the counters
+    lines = ["%-45s %10s %12s %14s" % ("stage", "calls", "total (s)", "mean (ms)")]
+    for name, (calls, seconds) in sorted(stages.items(), key = lambda item: -item[1][1]):
+        lines.append("%-45s %10d %12.3f %14.3f" % (name, calls, seconds, 1000. * seconds / calls))
+    lines.append("")
+    lines.append("%-45s %10s" % ("counter", "value"))
+    for name, value in sorted(counters.items()):
+        lines.append("%-45s %10s" % (name, value))
+    print("\n".join(lines))
+
+def writeReport(json_file):
+    with open(json_file, 'w') as report_file:
+        json.dump(getReport(), report_file, indent = 2)
+    logger.info('The instrumentation report is written to: ' + str(json_file))
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from dynamic_calc_framework import CalcFramework
+
+import virtualOS as vos
+import instrumentation
+
+import logging
+logger = logging.getLogger(__name__)
+
+def getRunoffTotals(catchment, netcdf_runoff, clone_map_file, dates, native_resolution = False, regrid_method = None):
+    # Total runoff (m3/day) within the catchment (see sparse_catchment) for every date, read in one call from the
+    # netcdf file(s) of netcdf_runoff (see vos.netcdf2NumpyCloneSeries) and reduced at once (time steps x active cells).
+
+    # runoff (from netcdf files, unit: kg m-2 s-1) at the input resolution
+    if native_resolution: regrid_method = None
+    runoff, factor = vos.netcdf2NumpyCloneSeries(netcdf_runoff["file_name"], \
+                                                 netcdf_runoff['variable_name'], \
+                                                 dates, \
+                                                 cloneMapFileName = clone_map_file, \
+                                                 regridMethod = regrid_method, \
+                                                 regridCells  = catchment.active_index)
+
+    if regrid_method != None:
+        # regridded for the active cells only (time steps x active cells)
+        return catchment.getRunoffTotal(runoff)
+
+    if native_resolution:
+        # with the coarse weights (see sparse_catchment)
+        return catchment.getRunoffTotalNative(runoff, factor)
+
+    # runoff values of the active cells (time steps x active cells)
+    active_rows, active_cols = catchment.getActiveRowsCols()
+    with instrumentation.stage("catchment: gather"):
+        runoff = runoff[:, active_rows // factor, active_cols // factor]
+
+    # the same float32 operations as the PCRaster maps
+    return catchment.getRunoffTotal(runoff)
+
+class MatrixCalcFramework(CalcFramework):
+    # Catchment averages for the entire period without the daily PCRaster pipeline.
+    #
+    # The catchment (active cells and their cell areas, see sparse_catchment) is prepared as in CalcFramework.
+    # Then, every block of time steps is read from the netcdf file (see vos.netcdf2NumpyCloneSeries) and
+    # reduced at once (time steps x active cells).
+
+    def __init__(self, modelTime, \
+                       input_files, \
+                       output_files):
+        # the whole period is read in blocks (see calculate), a prefetcher is not used
+        CalcFramework.__init__(self, modelTime, \
+                                     input_files, \
+                                     output_files, \
+                                     use_prefetcher = False)
+
+        logger.info('Number of active cells: ' + str(len(self.catchment.active_index)))
+
+        # number of time steps read and reduced at once
+        self.time_block_size = vos.getTimeBlockSize(self.input_files["netcdf_runoff"].get("time_slab_size"))
+
+    def run(self):
+
+        dates = []
+        for time_step in range(1, self.modelTime.nrOfTimeSteps + 1):
+            self.modelTime.update(time_step)
+            dates.append(str(self.modelTime.fulldate))
+            if len(dates) == self.time_block_size or self.modelTime.isLastTimeStep():
+                self.calculate(dates)
+                dates = []
+        self.result_writer.close()
+
+    def calculate(self, dates):
+
+        # total runoff (m3/day) within the catchment
+        runoff_total = getRunoffTotals(self.catchment, \
+                                       self.input_files["netcdf_runoff"], \
+                                       self.clone_map_file, \
+                                       dates, \
+                                       self.native_resolution, \
+                                       self.regrid_method)
+
+        with instrumentation.stage("output"):
+            for date, total in zip(dates, runoff_total):
+
+                # average runoff (mm/day) within the catchment
+                average_runoff_within_the_catchment = float(total) / (1000. * self.catchment_area)
+
+                self.result_writer.write(date, average_runoff_within_the_catchment)
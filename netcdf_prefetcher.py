@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import virtualOS as vos
+import instrumentation
+
+import logging
+logger = logging.getLogger(__name__)
+
+def startPrefetcher(netcdf_runoff, dates, cloneMapFileName = None, nativeResolution = False, regridMethod = None):
+    # To start the prefetcher of the netcdf file(s) of netcdf_runoff (see the input_files of the engines) if 
+    # netcdf_runoff["prefetch_depth"] is given. Returns None otherwise.
+    if netcdf_runoff.get("prefetch_depth") == None: return None
+    return NetCDFPrefetcher(netcdf_runoff["file_name"], \
+                            netcdf_runoff['variable_name'], \
+                            dates, \
+                            cloneMapFileName = cloneMapFileName, \
+                            timeSlabSize = netcdf_runoff.get("time_slab_size"), \
+                            depth = netcdf_runoff["prefetch_depth"], \
+                            nativeResolution = nativeResolution, \
+                            regridMethod = regridMethod)
+
+class NetCDFPrefetcher(object):
+    # To read netcdf fields (see vos.netcdf2NumpyClone) for the following dates in a background thread,
+    # while the current date is being processed.
+    #
+    # - All fields are read by one (background) thread, in the order of the dates, so that the netcdf/HDF5 library
+    #   is never used by two threads at the same time. Do not read the same file from the main thread meanwhile.
+    # - At most 'depth' fields are kept in the queue.
+    # - The fields must be requested (get) in the same order as the dates.
+    # - nativeResolution = True: the fields are read with vos.netcdf2NumpyCloneNative (get returns the field at 
+    #   the native resolution and the factor).
+    # - regridMethod: see vos.getRegridOperator (not used with nativeResolution).
+
+    def __init__(self, ncFile, varName, dates, \
+                       cloneMapFileName  = None, \
+                       specificFillValue = None, \
+                       timeSlabSize      = None, \
+                       depth             = 2, \
+                       nativeResolution  = False, \
+                       regridMethod      = None):
+        object.__init__(self)
+
+        self.ncFile = ncFile
+        self.varName = varName
+        self.dates = list(dates)
+        self.cloneMapFileName = cloneMapFileName
+        self.specificFillValue = specificFillValue
+        self.timeSlabSize = timeSlabSize
+        self.nativeResolution = nativeResolution
+        self.regridMethod = regridMethod
+
+        self._queue = queue.Queue(maxsize = max(1, int(depth)))
+        self._stop = threading.Event()
+
+        logger.debug('Prefetching '+str(len(self.dates))+' fields of the variable: '+str(varName)+' from the file: '+str(ncFile)+' (depth: '+str(depth)+')')
+        self._thread = threading.Thread(target = self._read)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _put(self, item):
+        # wait until there is room in the queue (or until the prefetcher is closed)
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout = 0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _read(self):
+        for date in self.dates:
+            try:
+                if self.nativeResolution:
+                    data = vos.netcdf2NumpyCloneNative(self.ncFile, self.varName, date, \
+                                                       useDoy = None, \
+                                                       cloneMapFileName  = self.cloneMapFileName, \
+                                                       specificFillValue = self.specificFillValue, \
+                                                       timeSlabSize      = self.timeSlabSize)
+                else:
+                    data = vos.netcdf2NumpyClone(self.ncFile, self.varName, date, \
+                                                 useDoy = None, \
+                                                 cloneMapFileName  = self.cloneMapFileName, \
+                                                 specificFillValue = self.specificFillValue, \
+                                                 timeSlabSize      = self.timeSlabSize, \
+                                                 regridMethod      = self.regridMethod)
+            except Exception as error:
+                self._put((date, None, error))
+                return
+            if not self._put((date, data, None)): return
+
+    def get(self, date, isLastDate = False):
+        # the field (numpy array, see vos.netcdf2NumpyClone) of the given date
+        # - isLastDate = True: the prefetcher is closed after this field
+        with instrumentation.stage("prefetcher: wait"):
+            prefetched_date, data, error = self._queue.get()
+        if error != None:
+            self.close()
+            raise error
+        if str(prefetched_date) != str(date):
+            self.close()
+            raise ValueError("The prefetched date "+str(prefetched_date)+" does not match the requested date "+str(date)+".")
+        if isLastDate: self.close()
+        return data
+
+    def close(self):
+        # stop the background thread and release the queued fields
+        self._stop.set()
+        while True:
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                break
+        self._thread.join()
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import multiprocessing
+
+import numpy as np
+
+import pcraster as pcr
+
+import virtualOS as vos
+import workspace
+from batch_calc_framework import getCatchmentTifFiles
+from result_writers import getResultWriter
+from sparse_catchment import getSparseCatchment, readCellArea
+import instrumentation
+
+import logging
+logger = logging.getLogger(__name__)
+
+# catchments of the worker process and the positions of their active cells in the regridded cells (set once by 
+# _initWorker)
+_worker_catchments = None
+_worker_positions  = None
+
+def _initWorker(catchments, positions):
+    global _worker_catchments, _worker_positions
+    _worker_catchments = catchments
+    _worker_positions  = positions
+
+def _reduceShard(task):
+    # To calculate the total runoff (m3/day) of the catchments of a shard, given the runoff fields in the block file
+    # of the main process (time steps x rows x cols, or time steps x regridded cells; float64). The file is mapped 
+    # read-only (np.memmap), without copying it.
+    block_file, shape, factor, native_resolution, catchment_indices = task
+    runoff = np.memmap(block_file, dtype = np.float64, mode = 'r', shape = shape)
+    runoff_total = np.zeros((shape[0], len(catchment_indices)), dtype = np.float64)
+    for i, i_catchment in enumerate(catchment_indices):
+        catchment = _worker_catchments[i_catchment]
+        if native_resolution:
+            runoff_total[:, i] = catchment.getRunoffTotalNative(runoff, factor)
+        elif _worker_positions != None:
+            runoff_total[:, i] = catchment.getRunoffTotal(runoff[:, _worker_positions[i_catchment]])
+        else:
+            rows, cols = catchment.getActiveRowsCols()
+            runoff_total[:, i] = catchment.getRunoffTotal(runoff[:, rows // factor, cols // factor])
+    del runoff
+    return catchment_indices, runoff_total
+
+def getShards(catchments, number_of_shards):
+    # To divide the catchments over the shards, balanced by the number of active cells (largest first, each to the
+    # shard with the least cells). The result does not depend on the order in which the workers finish.
+    number_of_shards = max(1, min(int(number_of_shards), len(catchments)))
+    shards = [[] for i in range(number_of_shards)]
+    number_of_cells = [0] * number_of_shards
+    for i_catchment in sorted(range(len(catchments)), key = lambda i: (-len(catchments[i].active_index), i)):
+        i_shard = number_of_cells.index(min(number_of_cells))
+        shards[i_shard].append(i_catchment)
+        number_of_cells[i_shard] += len(catchments[i_catchment].active_index)
+    return [sorted(shard) for shard in shards if len(shard) > 0]
+
+class ParallelBatchCalcFramework(object):
+    # Catchment averages for many catchments, sharded across a pool of worker processes.
+    #
+    # The catchments are prepared as in BatchCalcFramework (see sparse_catchment) and divided over the shards
+    # (see getShards). Every block of time steps is read once by the main process (see vos.netcdf2NumpyCloneSeries)
+    # into a file in its workspace (see workspace; /dev/shm if possible); every worker maps it (np.memmap) and 
+    # reduces the catchments of its shard.
+    # The results are merged in the order of the stations and dates before they are written (see result_writers).
+
+    def __init__(self, modelTime, \
+                       input_files, \
+                       output_files, \
+                       number_of_workers = None):
+        object.__init__(self)
+
+        self.input_files  = input_files
+        self.output_files = output_files
+
+        # use cell area as the clone map
+        self.clone_map_file = self.input_files["cellarea_0.05deg_file"]
+        pcr.setclone( self.clone_map_file)
+
+        # cell area (m2)
+        cell_area = readCellArea(self.input_files, self.clone_map_file, self.output_files['tmp_output_folder'])
+
+        # the catchments as their active cells (see sparse_catchment; from the cache if available)
+        self.tif_catchment_files = getCatchmentTifFiles(self.input_files["tif_catchment_files"])
+        self.station_ids = [vos.getStationID(tif_file) for tif_file in self.tif_catchment_files]
+        self.catchments = []
+        for i_catchment, tif_file in enumerate(self.tif_catchment_files):
+            self.catchments.append(getSparseCatchment(tif_file, \
+                                                      self.clone_map_file, \
+                                                      cell_area, \
+                                                      self.output_files['tmp_output_folder'], \
+                                                      cache_folder = self.input_files.get("catchment_cache_folder"), \
+                                                      station_id = self.station_ids[i_catchment], \
+                                                      cell_area_source = self.input_files.get("cell_area_source", "map")))
+        self.catchment_area = np.array([catchment.catchment_area for catchment in self.catchments], dtype = np.float64)  # unit: m2
+        logger.info('Number of catchments: ' + str(len(self.catchments)))
+
+        # shards (default: one for every core)
+        if number_of_workers == None: number_of_workers = multiprocessing.cpu_count()
+        self.shards = getShards(self.catchments, number_of_workers)
+        self.number_of_workers = len(self.shards)
+        logger.info('Number of worker processes: ' + str(self.number_of_workers))
+
+        # reduce the runoff at the native resolution of the netcdf file (see sparse_catchment.getCoarseWeights)
+        self.native_resolution = self.input_files["netcdf_runoff"].get("native_resolution", False)
+        self.regrid_method     = self.input_files["netcdf_runoff"].get("regrid_method")
+        if self.native_resolution: self.regrid_method = None
+
+        # with regrid_method, only the active cells of all catchments are regridded (see vos.applyRegridOperator); 
+        # the positions of the active cells of every catchment in these cells
+        self.regrid_cells = None ; self.positions = None
+        if self.regrid_method != None:
+            self.regrid_cells = np.unique(np.concatenate([catchment.active_index for catchment in self.catchments]))
+            self.positions = [np.searchsorted(self.regrid_cells, catchment.active_index) for catchment in self.catchments]
+            logger.info('Number of regridded cells: ' + str(len(self.regrid_cells)))
+
+        # number of time steps read and reduced at once
+        self.time_block_size = vos.getTimeBlockSize(self.input_files["netcdf_runoff"].get("time_slab_size"))
+
+        # output file (see result_writers; e.g. "table": one column for every station)
+        self.result_writer = getResultWriter(self.output_files, self.station_ids, self.catchment_area, default_format = "table")
+
+        # time variable/object
+        self.modelTime = modelTime
+
+    def run(self):
+
+        # workspace for the block file (removed at the end)
+        self.block_folder = workspace.createWorkspace(prefix = "parallel_batch_", fallbackFolder = self.output_files['tmp_output_folder'], \
+                                                      baseFolder = self.output_files.get('workspace_folder'))
+
+        pool = multiprocessing.Pool(self.number_of_workers, initializer = _initWorker, initargs = (self.catchments, self.positions))
+        try:
+            dates = []
+            for time_step in range(1, self.modelTime.nrOfTimeSteps + 1):
+                self.modelTime.update(time_step)
+                dates.append(str(self.modelTime.fulldate))
+                if len(dates) == self.time_block_size or self.modelTime.isLastTimeStep():
+                    self.calculate(pool, dates)
+                    dates = []
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            workspace.removeWorkspace(self.block_folder)
+        self.result_writer.close()
+
+    def calculate(self, pool, dates):
+
+        block_file = os.path.join(self.block_folder, "runoff_block.dat")
+        try:
+            # runoff (from netcdf files, unit: kg m-2 s-1), read once for all workers, directly into the block file
+            shape, factor = vos.getNCCloneSeriesShape(self.input_files["netcdf_runoff"]["file_name"], \
+                                                      dates, \
+                                                      cloneMapFileName = self.clone_map_file, \
+                                                      regridMethod = self.regrid_method, \
+                                                      regridCells  = self.regrid_cells)
+            block = np.memmap(block_file, dtype = np.float64, mode = 'w+', shape = shape)
+            vos.netcdf2NumpyCloneSeries(self.input_files["netcdf_runoff"]["file_name"], \
+                                        self.input_files["netcdf_runoff"]['variable_name'], \
+                                        dates, \
+                                        cloneMapFileName = self.clone_map_file, \
+                                        regridMethod = self.regrid_method, \
+                                        regridCells  = self.regrid_cells, \
+                                        out = block)
+            block.flush() ; del block
+
+            # total runoff (m3/day) of every catchment, merged in the order of the stations
+            runoff_total = np.zeros((len(dates), len(self.catchments)), dtype = np.float64)
+            tasks = [(block_file, shape, factor, self.native_resolution, shard) for shard in self.shards]
+            with instrumentation.stage("parallel: reduction"):
+                for catchment_indices, shard_total in pool.imap_unordered(_reduceShard, tasks):
+                    runoff_total[:, catchment_indices] = shard_total
+        finally:
+            if os.path.exists(block_file): os.remove(block_file)
+
+        # average runoff (mm/day) within every catchment
+        average_runoff = runoff_total / (1000. * self.catchment_area)
+
+        with instrumentation.stage("output"):
+            for date, values in zip(dates, average_runoff):
+                self.result_writer.write(date, values)
@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import datetime
+
+import numpy as np
+
+import logging
+logger = logging.getLogger(__name__)
+
+# file extensions of the output formats
+output_extensions = {"txt"   : ".txt",\
+                     "csv"   : ".csv",\
+                     "table" : ".csv",\
+                     "npy"   : ".npy",\
+                     "netcdf": ".nc"}
+
+def getResultWriter(output_files, station_ids, catchment_areas, default_format = "txt"):
+    # To create the result writer (sink) given in output_files['output_format']. Without an output format (None), 
+    # the default format of the engine is used ("txt" for a single catchment, "table" in batch mode) and the file 
+    # name is output_files['output_txt_file'], as in the earlier versions. Otherwise, the file name is 
+    # output_files['output_txt_file'] with the extension of the output format.
+    output_format  = output_files.get('output_format')
+    flush_interval = output_files.get('flush_interval', 30)
+    verbose        = output_files.get('verbose', False)
+
+    if output_format == None:
+        output_format = default_format
+        file_name = output_files['output_txt_file']
+    else:
+        file_name = os.path.splitext(output_files['output_txt_file'])[0] + output_extensions[output_format]
+
+    writers = {"txt"   : TextResultWriter,\
+               "csv"   : CSVResultWriter,\
+               "table" : TableResultWriter,\
+               "npy"   : NumpyResultWriter,\
+               "netcdf": NetCDFResultWriter}
+    return writers[output_format](file_name, station_ids, catchment_areas, flush_interval, verbose)
+
+class ResultWriter(object):
+    # Base class of the result writers.
+    #
+    # Results are given for every date as an array with the average runoff (mm/day) of every station
+    # (same order as station_ids). They are kept in a buffer and written every 'flush_interval' dates
+    # (and when the writer is closed). With verbose = True, the results are also printed to the screen.
+    #
+    # Interface of the writers (subclasses):
+    # - _write_rows(dates, values): to write the buffered rows, i.e. a list of dates (strings) and a list of 
+    #   arrays (one value for every station); called by flush. Every writer must define it.
+    # - _close(): to finish and close the file (optional).
+
+    def __init__(self, file_name, station_ids, catchment_areas, flush_interval = 30, verbose = False):
+        object.__init__(self)
+
+        self.file_name       = file_name
+        self.station_ids     = [str(station_id) for station_id in station_ids]
+        self.catchment_areas = np.asarray(catchment_areas, dtype = np.float64)
+        self.flush_interval  = max(1, int(flush_interval))
+        self.verbose         = verbose
+
+        self._dates  = []
+        self._values = []
+        self._closed = False
+
+    def write_info(self, text):
+        # general information (e.g. input files); only written by the text writer
+        logger.info(text.strip())
+        if self.verbose: print(text)
+
+    def write(self, date, mean_mm_day):
+        mean_mm_day = np.atleast_1d(np.asarray(mean_mm_day, dtype = np.float64))
+        self._dates.append(str(date))
+        self._values.append(mean_mm_day)
+        if self.verbose: self._print(str(date), mean_mm_day)
+        if len(self._dates) >= self.flush_interval: self.flush()
+
+    def _print(self, date, values):
+        for station_id, value in zip(self.station_ids, values):
+            print(date + " " + station_id + " : " + str(float(value)))
+
+    def flush(self):
+        if len(self._dates) > 0: self._write_rows(self._dates, self._values)
+        self._dates  = []
+        self._values = []
+
+    def close(self):
+        if self._closed: return
+        self.flush()
+        self._close()
+        self._closed = True
+        logger.info('Results are written to the file: ' + str(self.file_name))
+
+    def _close(self):
+        pass
+
+class TextResultWriter(ResultWriter):
+    # the text sentences of the original CalcFramework (one line for every date and station)
+
+    def __init__(self, file_name, station_ids, catchment_areas, flush_interval = 30, verbose = False):
+        ResultWriter.__init__(self, file_name, station_ids, catchment_areas, flush_interval, verbose)
+        self.txt_out_file = open(self.file_name, 'w')
+
+    def write_info(self, text):
+        ResultWriter.write_info(self, text)
+        self.txt_out_file.write(text)
+
+    def _print(self, date, values):
+        for line in self._lines(date, values): print(line)
+
+    def _lines(self, date, values):
+        lines = []
+        for station_id, value in zip(self.station_ids, values):
+            line = 'Average runoff within the catchment (mm/day) for the date '  + date + " : " + str(float(value)) + " \n"
+            if len(self.station_ids) > 1: line = station_id + " : " + line
+            lines.append(line)
+        return lines
+
+    def _write_rows(self, dates, values):
+        lines = []
+        for date, date_values in zip(dates, values): lines += self._lines(date, date_values)
+        self.txt_out_file.write("".join(lines))
+        self.txt_out_file.flush()
+
+    def _close(self):
+        self.txt_out_file.close()
+
+class CSVResultWriter(ResultWriter):
+    # columns: date, station_id, mean_mm_day, catchment_area (one row for every date and station)
+
+    def __init__(self, file_name, station_ids, catchment_areas, flush_interval = 30, verbose = False):
+        ResultWriter.__init__(self, file_name, station_ids, catchment_areas, flush_interval, verbose)
+        self.csv_out_file = open(self.file_name, 'w')
+        self.csv_out_file.write("date,station_id,mean_mm_day,catchment_area\n")
+
+    def _write_rows(self, dates, values):
+        lines = []
+        for date, date_values in zip(dates, values):
+            for station_id, value, area in zip(self.station_ids, date_values, self.catchment_areas):
+                lines.append(date + "," + station_id + "," + repr(float(value)) + "," + repr(float(area)) + "\n")
+        self.csv_out_file.write("".join(lines))
+        self.csv_out_file.flush()
+
+    def _close(self):
+        self.csv_out_file.close()
+
+class TableResultWriter(ResultWriter):
+    # one row for every date and one column for every station
+
+    def __init__(self, file_name, station_ids, catchment_areas, flush_interval = 30, verbose = False):
+        ResultWriter.__init__(self, file_name, station_ids, catchment_areas, flush_interval, verbose)
+        self.csv_out_file = open(self.file_name, 'w')
+        self.csv_out_file.write("date," + ",".join(self.station_ids) + "\n")
+
+    def _write_rows(self, dates, values):
+        lines = []
+        for date, date_values in zip(dates, values):
+            lines.append(date + "," + ",".join([repr(float(value)) for value in date_values]) + "\n")
+        self.csv_out_file.write("".join(lines))
+        self.csv_out_file.flush()
+
+    def _close(self):
+        self.csv_out_file.close()
+
+class NumpyResultWriter(ResultWriter):
+    # A structured numpy array (date, station_id, mean_mm_day, catchment_area) saved as a .npy file.
+    # - The .npy format cannot be appended, so the file is written when the writer is closed.
+
+    def __init__(self, file_name, station_ids, catchment_areas, flush_interval = 30, verbose = False):
+        ResultWriter.__init__(self, file_name, station_ids, catchment_areas, flush_interval, verbose)
+        self._all_dates  = []
+        self._all_values = []
+
+    def _write_rows(self, dates, values):
+        self._all_dates  += dates
+        self._all_values += values
+
+    def _close(self):
+        number_of_stations = len(self.station_ids)
+        number_of_dates    = len(self._all_dates)
+        id_length = max([1] + [len(station_id) for station_id in self.station_ids])
+        results = np.zeros(number_of_dates * number_of_stations, \
+                           dtype = [('date', 'S10'), ('station_id', 'S' + str(id_length)), \
+                                    ('mean_mm_day', np.float64), ('catchment_area', np.float64)])
+        results['date']           = np.repeat(np.array(self._all_dates, dtype = 'S10'), number_of_stations)
+        results['station_id']     = np.tile(np.array(self.station_ids, dtype = 'S' + str(id_length)), number_of_dates)
+        if number_of_dates > 0: results['mean_mm_day'] = np.concatenate(self._all_values)
+        results['catchment_area'] = np.tile(self.catchment_areas, number_of_dates)
+        np.save(self.file_name, results)
+
+class NetCDFResultWriter(ResultWriter):
+    # A netcdf time series file with the dimensions time and station.
+
+    def __init__(self, file_name, station_ids, catchment_areas, flush_interval = 30, verbose = False):
+        ResultWriter.__init__(self, file_name, station_ids, catchment_areas, flush_interval, verbose)
+
+        import netCDF4 as nc
+        self._nc = nc
+
+        self.rootgrp = nc.Dataset(self.file_name, 'w', format = 'NETCDF4')
+        self.rootgrp.createDimension('time', None)
+        self.rootgrp.createDimension('station', len(self.station_ids))
+
+        time = self.rootgrp.createVariable('time', 'f8', ('time',))
+        time.units    = 'days since 1901-01-01'
+        time.calendar = 'standard'
+
+        station_id = self.rootgrp.createVariable('station_id', str, ('station',))
+        for i_station, value in enumerate(self.station_ids): station_id[i_station] = value
+
+        catchment_area = self.rootgrp.createVariable('catchment_area', 'f8', ('station',))
+        catchment_area.units = 'm2'
+        catchment_area[:] = self.catchment_areas
+
+        mean_mm_day = self.rootgrp.createVariable('mean_mm_day', 'f8', ('time', 'station'), fill_value = 1e20)
+        mean_mm_day.units     = 'mm.day-1'
+        mean_mm_day.long_name = 'average runoff within the catchment'
+
+        self._index = 0
+
+    def _write_rows(self, dates, values):
+        times = [datetime.datetime.strptime(date, '%Y-%m-%d') for date in dates]
+        time = self.rootgrp.variables['time']
+        sta = self._index ; end = self._index + len(dates)
+        time[sta:end] = self._nc.date2num(times, time.units, time.calendar)
+        self.rootgrp.variables['mean_mm_day'][sta:end,:] = np.array(values)
+        self._index = end
+        self.rootgrp.sync()
+
+    def _close(self):
+        self.rootgrp.close()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+import pcraster as pcr
+
+import virtualOS as vos
+import catchment_cache
+import instrumentation
+
+import logging
+logger = logging.getLogger(__name__)
+
+def readCellArea(input_files, clone_map_file, tmp_output_folder):
+    # Cell area (m2) on the clone as a float32 numpy array with MV for missing values:
+    # - input_files["cell_area_source"] = "map" (default): read from input_files['cellarea_0.05deg_file']
+    # - "analytic": calculated for the clone grid (see vos.getCellAreaGrid), without reading/warping a map
+    cell_area_source = input_files.get("cell_area_source", "map")
+    if cell_area_source == "analytic":
+        return vos.getCellAreaGridOfClone(clone_map_file, dtype = np.float32)
+    cell_area_map = vos.readPCRmapClone(input_files['cellarea_0.05deg_file'], clone_map_file, tmp_output_folder)
+    return pcr.pcr2numpy(cell_area_map, vos.MV)
+
+def getSparseCatchment(tif_catchment_file, clone_map_file, cell_area, tmp_output_folder, \
+                       cache_folder = None, station_id = None, cell_area_source = "map"):
+    # To get the SparseCatchment of a catchment tif file, from the cache (see catchment_cache) if available,
+    # otherwise by resampling the tif file to the clone (the result is then saved to the cache).
+    #
+    # cell_area: cell area (m2) numpy array on the clone with MV for missing values (see readCellArea)
+    prepared_catchment = catchment_cache.loadPreparedCatchment(cache_folder, tif_catchment_file, clone_map_file, \
+                                                               cell_area_source = cell_area_source)
+    if prepared_catchment == None:
+
+        # resample tif to the extent of the clone and set it as the catchment and landmask maps
+        catchment = vos.readCatchmentTifClone(tif_catchment_file, clone_map_file, tmp_output_folder)
+        landmask  = pcr.pcr2numpy(pcr.defined(catchment), 0).astype(bool)
+
+        # active cells, weights and catchment area (m2)
+        prepared_catchment = catchment_cache.prepareCatchment(landmask, cell_area)
+        catchment_cache.savePreparedCatchment(cache_folder, tif_catchment_file, clone_map_file, prepared_catchment, \
+                                              cell_area_source = cell_area_source)
+
+    return SparseCatchment(prepared_catchment, station_id)
+
+class SparseCatchment(object):
+    # A catchment as the flat indexes (int32) of its active cells on the clone (i.e. cells within the catchment that
+    # have cell area values) and their cell areas (float32, m2) as the weights.
+    #
+    # Only the active cells of the (clone) runoff fields are gathered, instead of masking the entire clone.
+    # The runoff fields can also be reduced at their native (coarser) resolution, see getCoarseWeights.
+
+    def __init__(self, prepared_catchment, station_id = None):
+        object.__init__(self)
+
+        self.station_id     = station_id
+        self.shape          = tuple(prepared_catchment['shape'])
+        self.active_index   = np.asarray(prepared_catchment['active_index'], dtype = np.int32)
+        self.weights        = np.asarray(prepared_catchment['active_cell_area'], dtype = np.float32)
+        self.catchment_area = float(prepared_catchment['catchment_area'])      # unit: m2
+
+        # coarse weights (key: factor), see getCoarseWeights
+        self._coarse_weights = {}
+
+        logger.debug('Number of active cells of the catchment ' + str(station_id) + ': ' + str(len(self.active_index)))
+
+    def getActiveRowsCols(self):
+        # rows and columns (on the clone) of the active cells
+        return np.unravel_index(self.active_index, self.shape)
+
+    def gather(self, field):
+        # values of the active cells of a field (clone) or of a series of fields (time steps x clone)
+        with instrumentation.stage("catchment: gather"):
+            field = np.asarray(field)
+            return field.reshape(field.shape[:-2] + (-1,))[..., self.active_index]
+
+    def getRunoffTotal(self, runoff):
+        # Total runoff (m3/day) of the active cell runoff values (unit: kg m-2 s-1, MV for missing values; the last
+        # axis is the active cells). The values are converted with the same float32 (PCRaster REAL4) operations as
+        # in the original PCRaster maps and the totals are rounded to float32, as the PCRaster map total.
+        with instrumentation.stage("catchment: reduction"):
+            valid  = runoff != vos.MV
+            runoff = np.asarray(runoff).astype(np.float32) * np.float32(1000.) * self.weights * np.float32(86400.) * np.float32(-1.0)
+            runoff[~valid] = 0.0
+            return np.sum(runoff, axis = -1, dtype = np.float64).astype(np.float32)
+
+    def getAverageRunoff(self, runoff):
+        # average runoff (mm/day) within the catchment, given the runoff field (clone, unit: kg m-2 s-1)
+        return float(self.getRunoffTotal(self.gather(runoff))) / (1000. * self.catchment_area)
+
+    def getCoarseWeights(self, factor):
+        # The active cells aggregated (once) to a grid that is 'factor' times coarser than the clone, e.g. the native 
+        # grid of the netcdf file (see vos.netcdf2NumpyCloneNative): the rows and columns (int32) of the coarse cells 
+        # and the cell area (float64, m2) of the catchment within every coarse cell. 
+        if factor not in self._coarse_weights:
+            rows, cols   = self.getActiveRowsCols()
+            coarse_cols  = self.shape[1] // factor + 1
+            coarse_index = (rows // factor).astype(np.int64) * coarse_cols + cols // factor
+            coarse_index, inverse = np.unique(coarse_index, return_inverse = True)
+            weights = np.bincount(inverse, weights = self.weights.astype(np.float64))
+            self._coarse_weights[factor] = ((coarse_index // coarse_cols).astype(np.int32), \
+                                            (coarse_index %  coarse_cols).astype(np.int32), weights)
+            logger.debug('Number of coarse cells of the catchment ' + str(self.station_id) + ': ' + str(len(weights)))
+        return self._coarse_weights[factor]
+
+    def getRunoffTotalNative(self, runoff, factor):
+        # Total runoff (m3/day) given the runoff at the native resolution (the last two axes: coarse rows and columns,
+        # unit: kg m-2 s-1, MV for missing values; see vos.netcdf2NumpyCloneNative). Every coarse value is weighted 
+        # with the catchment area within the coarse cell (see getCoarseWeights), so no fine (clone) grid is built. 
+        # The result equals getRunoffTotal of the resampled field, except for the rounding (calculated in float64).
+        rows, cols, weights = self.getCoarseWeights(factor)
+        with instrumentation.stage("catchment: gather"):
+            runoff = np.asarray(runoff)[..., rows, cols]
+        with instrumentation.stage("catchment: reduction"):
+            runoff = np.where(runoff != vos.MV, runoff, 0.0)
+            return np.sum(runoff * weights, axis = -1) * 1000. * 86400. * -1.0
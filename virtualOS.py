@@ -5,6 +5,7 @@
 #                      The list is continuation from Rens's and Dominik's.
 
 import shutil
+import glob
 import subprocess
 import datetime
 import random
@@ -14,12 +15,31 @@ import re
 import math
 import sys
 import types
+import struct
+import atexit
+import threading
+import collections
 
 import netCDF4 as nc
 import numpy as np
 import numpy.ma as ma
 import pcraster as pcr
 
+import instrumentation
+
+# scipy (optional): used for the sparse regridding operators (see getRegridOperator)
+try:
+    import scipy.sparse as sparse
+except ImportError:
+    sparse = None
+
+# GDAL python bindings (optional): used for in-process warping; without them, the gdal command line tools are used.
+try:
+    from osgeo import gdal
+    gdal.UseExceptions()
+except ImportError:
+    gdal = None
+
 import logging
 logger = logging.getLogger(__name__)
 
@@ -27,8 +47,107 @@ logger = logging.getLogger(__name__)
 MV = 1e20
 smallNumber = 1E-39
 
-# file cache to minimize/reduce opening/closing files.  
-filecache = dict()
+class NetCDFFileCache(object):
+    # File cache to minimize/reduce opening/closing netcdf files: a bounded LRU cache of open nc.Dataset handles.
+    # - At most maxOpenFiles files are kept open; the least recently used file is closed when another file is opened.
+    #   (maxOpenFiles must be larger than the number of files that are read at the same time, e.g. by a prefetcher.)
+    # - All files are closed at exit.
+    # - A lock is used, so that it can be used by several (reader) threads.
+
+    def __init__(self, maxOpenFiles = 32):
+        object.__init__(self)
+        self.maxOpenFiles = maxOpenFiles
+        self._datasets = collections.OrderedDict()
+        self._lock = threading.RLock()
+        self.hits = 0 ; self.misses = 0 ; self.evictions = 0
+
+    def get(self, ncFile):
+        # the open nc.Dataset of ncFile (opened if it is not in the cache)
+        with self._lock:
+            if ncFile in self._datasets:
+                f = self._datasets.pop(ncFile)
+                self._datasets[ncFile] = f
+                self.hits += 1
+                instrumentation.count("filecache hits")
+                return f
+            self.misses += 1
+            instrumentation.count("filecache misses")
+            with instrumentation.stage("netcdf: open"):
+                f = nc.Dataset(ncFile)
+            self._datasets[ncFile] = f
+            while len(self._datasets) > max(1, self.maxOpenFiles):
+                oldFile, oldDataset = self._datasets.popitem(last = False)
+                logger.debug('Close the least recently used netcdf file: '+str(oldFile))
+                oldDataset.close()
+                self.evictions += 1
+                instrumentation.count("filecache evictions")
+            return f
+
+    def close(self, ncFile):
+        with self._lock:
+            if ncFile in self._datasets: self._datasets.pop(ncFile).close()
+
+    def clear(self):
+        # close all files
+        with self._lock:
+            while len(self._datasets) > 0:
+                ncFile, f = self._datasets.popitem(last = False)
+                try:
+                    f.close()
+                except Exception:
+                    pass
+
+    def keys(self):
+        with self._lock:
+            return list(self._datasets.keys())
+
+    def __contains__(self, ncFile):
+        return ncFile in self._datasets
+
+    def __len__(self):
+        return len(self._datasets)
+
+    def getStatistics(self):
+        return {'open_files': len(self._datasets),\
+                'hits'      : self.hits,\
+                'misses'    : self.misses,\
+                'evictions' : self.evictions}
+
+# file cache to minimize/reduce opening/closing files (see NetCDFFileCache).  
+filecache = NetCDFFileCache(maxOpenFiles = 32)
+atexit.register(filecache.clear)
+
+# cache of decoded netcdf time axes (key: netcdf file name)
+timecache = dict()
+# warnings given while selecting netcdf time (to avoid repeating them every time step)
+warnedtimes = set()
+
+# crop windows of netcdf files on clone maps (key: netcdf file name and clone map file name)
+windowcache = dict()
+
+# cache of time slabs read from netcdf files (key: variable name and window; with the file name in the value)
+slabcache = dict()
+
+# cell area grids (key: grid definition, earth radius and dtype), see getCellAreaGrid
+cellareacache = dict()
+# earth radius (m) of the cell area grids (the authalic radius of WGS84; within 1e-4 of australia_cellsize0.05deg.map)
+earthRadius = 6371007.2
+
+# sparse regridding operators (key: netcdf grid, clone map and method), see getRegridOperator
+regridcache = dict()
+
+# water balance checks (see waterBalanceCheck and waterBalance); can be switched off in production runs
+waterBalanceChecks = True
+
+# number of days before the end of a netcdf file (of a series of yearly files) when the next file is opened
+ncLookaheadDays = 1
+
+# cache of map attributes (key: file path, modification time and size)
+mapattrcache = dict()
+
+# PCRaster CSF (Cross System Format) header
+CSF_SIGNATURE   = b'RUU CROSS SYSTEM MAP FORMAT'
+CSF_HEADER_SIZE = 256
 
 def initialize_logging(log_file_location, log_file_front_name = "log", debug_mode = True):
     """
@@ -103,24 +222,16 @@ def netcdf2PCRobjCloneWithoutTime(ncFile,varName,
     #     Only works if cells are 'square'.
     #     Only works if cellsizeClone <= cellsizeInput
     # Get netCDF file and variable name:
-    if ncFile in filecache.keys():
-        f = filecache[ncFile]
-        #~ print "Cached: ", ncFile
-    else:
-        f = nc.Dataset(ncFile)
-        filecache[ncFile] = f
-        #~ print "New: ", ncFile
+    f = filecache.get(ncFile)
     
-    #print ncFile
-    #f = nc.Dataset(ncFile)  
     varName = str(varName)
     
+    # latitude and longitude variables (without changing the variables of the cached file)
+    lat = f.variables['lat'] if 'lat' in f.variables else None
+    lon = f.variables['lon'] if 'lon' in f.variables else None
     if LatitudeLongitude == True:
-        try:
-            f.variables['lat'] = f.variables['latitude']
-            f.variables['lon'] = f.variables['longitude']
-        except:
-            pass
+        if 'latitude'  in f.variables: lat = f.variables['latitude']
+        if 'longitude' in f.variables: lon = f.variables['longitude']
     
     sameClone = True
     # check whether clone and input maps have the same attributes:
@@ -133,12 +244,12 @@ def netcdf2PCRobjCloneWithoutTime(ncFile,varName,
         xULClone = attributeClone['xUL']
         yULClone = attributeClone['yUL']
         # get the attributes of input (netCDF) 
-        cellsizeInput = f.variables['lat'][0]- f.variables['lat'][1]
+        cellsizeInput = lat[0]- lat[1]
         cellsizeInput = float(cellsizeInput)
-        rowsInput = len(f.variables['lat'])
-        colsInput = len(f.variables['lon'])
-        xULInput = f.variables['lon'][0]-0.5*cellsizeInput
-        yULInput = f.variables['lat'][0]+0.5*cellsizeInput
+        rowsInput = len(lat)
+        colsInput = len(lon)
+        xULInput = lon[0]-0.5*cellsizeInput
+        yULInput = lat[0]+0.5*cellsizeInput
         # check whether both maps have the same attributes 
         if cellsizeClone != cellsizeInput: sameClone = False
         if rowsClone != rowsInput: sameClone = False
@@ -150,18 +261,18 @@ def netcdf2PCRobjCloneWithoutTime(ncFile,varName,
     factor = 1                                 # needed in regridData2FinerGrid
     if sameClone == False:
         # crop to cloneMap:
-        minX    = min(abs(f.variables['lon'][:] - (xULClone + 0.5*cellsizeInput))) # ; print(minX)
-        xIdxSta = int(np.where(abs(f.variables['lon'][:] - (xULClone + 0.5*cellsizeInput)) == minX)[0])
+        minX    = min(abs(lon[:] - (xULClone + 0.5*cellsizeInput))) # ; print(minX)
+        xIdxSta = int(np.where(abs(lon[:] - (xULClone + 0.5*cellsizeInput)) == minX)[0])
         xIdxEnd = int(math.ceil(xIdxSta + colsClone /(cellsizeInput/cellsizeClone)))
-        minY    = min(abs(f.variables['lat'][:] - (yULClone - 0.5*cellsizeInput))) # ; print(minY)
-        yIdxSta = int(np.where(abs(f.variables['lat'][:] - (yULClone - 0.5*cellsizeInput)) == minY)[0])
+        minY    = min(abs(lat[:] - (yULClone - 0.5*cellsizeInput))) # ; print(minY)
+        yIdxSta = int(np.where(abs(lat[:] - (yULClone - 0.5*cellsizeInput)) == minY)[0])
         yIdxEnd = int(math.ceil(yIdxSta + rowsClone /(cellsizeInput/cellsizeClone)))
         cropData = f.variables[varName][yIdxSta:yIdxEnd,xIdxSta:xIdxEnd]
         factor = int(round(float(cellsizeInput)/float(cellsizeClone)))
 
         if factor > 1: logger.debug('Resample: input cell size = '+str(float(cellsizeInput))+' ; output/clone cell size = '+str(float(cellsizeClone)))
     
-    # convert to PCR object and close f
+    # convert to PCR object
     if specificFillValue != None:
         outPCR = pcr.numpy2pcr(pcr.Scalar, \
                   regridData2FinerGrid(factor,cropData,MV), \
@@ -185,32 +296,222 @@ def netcdf2PCRobjClone(ncFile,varName,dateInput,\
                        useDoy = None,
                        cloneMapFileName  = None,\
                        LatitudeLongitude = True,\
-                       specificFillValue = None):
+                       specificFillValue = None,\
+                       timeSlabSize      = None,\
+                       regridMethod      = None):
+    # 
+    # EHS (19 APR 2013): To convert netCDF (tss) file to PCR file.
+    # - see netcdf2NumpyClone
+    outData = netcdf2NumpyClone(ncFile, varName, dateInput, useDoy, \
+                                cloneMapFileName, LatitudeLongitude, specificFillValue, \
+                                timeSlabSize, regridMethod)
+    with instrumentation.stage("numpy2pcr"):
+        outPCR = pcr.numpy2pcr(pcr.Scalar, outData, MV)
+    # PCRaster object
+    return (outPCR)
+
+def netcdf2NumpyClone(ncFile,varName,dateInput,\
+                      useDoy = None,
+                      cloneMapFileName  = None,\
+                      LatitudeLongitude = True,\
+                      specificFillValue = None,\
+                      timeSlabSize      = None,\
+                      regridMethod      = None):
+    # 
+    # To read a netCDF field, cropped and resampled to the clone map, as a numpy array. 
+    # Missing values are set to MV. 
+    # With timeSlabSize (an integer or "auto"), consecutive time steps are read in blocks (see readNetCDFTimeSlab).
     # 
     # EHS (19 APR 2013): To convert netCDF (tss) file to PCR file.
     # --- with clone checking
     #     Only works if cells are 'square'.
     #     Only works if cellsizeClone <= cellsizeInput
-    # Get netCDF file and variable name:
+    # With regridMethod ("nearest" or "conservative"), a cached sparse regridding operator is used instead 
+    # (see netcdf2NumpyCloneRegrid).
+    if regridMethod != None:
+        return netcdf2NumpyCloneRegrid(ncFile, varName, dateInput, useDoy, cloneMapFileName, \
+                                       specificFillValue, timeSlabSize, regridMethod)
+    cropData, factor = netcdf2NumpyCloneNative(ncFile, varName, dateInput, useDoy, \
+                                               cloneMapFileName, LatitudeLongitude, specificFillValue, \
+                                               timeSlabSize)
     
-    #~ print ncFile
+    with instrumentation.stage("regridData2FinerGrid"):
+        outData = regridData2FinerGrid(factor,cropData,MV)
+                  
+    cropData = None 
+    # numpy array
+    return (outData)
+
+def netcdf2NumpyCloneNative(ncFile,varName,dateInput,\
+                            useDoy = None,
+                            cloneMapFileName  = None,\
+                            LatitudeLongitude = True,\
+                            specificFillValue = None,\
+                            timeSlabSize      = None):
+    # 
+    # As netcdf2NumpyClone, but without resampling: returns the field cropped to the clone map at the input 
+    # (native) resolution, with MV for missing values, and the factor needed to resample it to the clone map 
+    # (see regridData2FinerGrid).
     
-    logger.debug('reading variable: '+str(varName)+' from the file: '+str(ncFile))
+    ncFile = getNCFileOfDate(ncFile, dateInput, useDoy, cloneMapFileName)
+    f = filecache.get(ncFile)
+
+    # crop window (and orientation) of the netcdf file on the clone map - resolved only once (see getNCCloneWindow)
+    window = getNCCloneWindow(ncFile, f, cloneMapFileName)
     
-    if ncFile in filecache.keys():
-        f = filecache[ncFile]
-        #~ print "Cached: ", ncFile
-    else:
-        f = nc.Dataset(ncFile)
-        filecache[ncFile] = f
-        #~ print "New: ", ncFile
+    # read only the window covering the clone map
+    cropData = readNCFieldWindow(ncFile, f, varName, dateInput, useDoy, window, specificFillValue, timeSlabSize)
+    factor   = window['factor']                                                                # needed in regridData2FinerGrid
+    
+    f = None
+    return cropData, factor
+
+def netcdf2NumpyCloneRegrid(ncFile,varName,dateInput,\
+                            useDoy = None,
+                            cloneMapFileName  = None,\
+                            specificFillValue = None,\
+                            timeSlabSize      = None,\
+                            regridMethod      = "nearest"):
+    # 
+    # As netcdf2NumpyClone, but resampled to the clone map with a sparse regridding operator (see getRegridOperator;
+    # regridMethod: "nearest" or "conservative"), so the cell size ratio does not need to be an integer.
+    ncFile = getNCFileOfDate(ncFile, dateInput, useDoy, cloneMapFileName)
+    f = filecache.get(ncFile)
+
+    # the operator and its window - built only once for every grid, clone map and method
+    regridOperator = getRegridOperator(ncFile, f, cloneMapFileName, regridMethod)
+
+    cropData = readNCFieldWindow(ncFile, f, varName, dateInput, useDoy, regridOperator['window'], specificFillValue, timeSlabSize)
+
+    with instrumentation.stage("regrid operator"):
+        outData = applyRegridOperator(regridOperator, cropData)
+    
+    f = None ; cropData = None
+    return outData
+
+def getNCFileOfDate(ncFile, dateInput, useDoy = None, cloneMapFileName = None):
+    # a file series (e.g. yearly files): the file of the date (the next file is opened ahead of time)
+    if isNCFileSeries(ncFile):
+        if useDoy == "Yes": raise ValueError("useDoy = 'Yes' cannot be used with a series of netcdf files: "+str(ncFile))
+        openNextNCFile(ncFile, dateInput, cloneMapFileName)
+        ncFile = getNCFileName(ncFile, dateInput)
+    return ncFile
+
+def readNCFieldWindow(ncFile, f, varName, dateInput, useDoy, window, specificFillValue = None, timeSlabSize = None):
+    # To read the field of a date within a window (see getNCCloneWindow), flipped if window['flip'] is True,
+    # as float64 with MV for missing values.
+    logger.debug('reading variable: '+str(varName)+' from the file: '+str(ncFile))
     
     varName = str(varName)
- 
-    lat = f.variables['lat'][:]
-    lon = f.variables['lon'][:]
     
-    # date
+    # time index (in the netCDF file)
+    with instrumentation.stage("netcdf: time index"):
+        idx = getNCTimeIndexOfDate(ncFile, f, varName, dateInput, useDoy)
+
+    with instrumentation.stage("netcdf: read"):
+        cropData = readNetCDFTimeSlab(ncFile, f, varName, idx, timeSlabSize, window)   # still original data
+
+    with instrumentation.stage("netcdf: crop and missing values"):
+        # flip if necessary 
+        if window['flip']: cropData = cropData[::-1,:]
+
+        # set missing values to MV
+        if specificFillValue != None:
+            missingValue = float(specificFillValue)
+        else:
+            missingValue = float(f.variables[varName]._FillValue)
+        cropData = np.ma.filled(cropData).astype(np.float64)
+        cropData = np.where(cropData == missingValue, MV, cropData)
+    return cropData
+
+def getRegridOperator(ncFile, f, cloneMapFileName, regridMethod = "nearest"):
+    # A sparse matrix (scipy.sparse CSR) from the netcdf cells within a window (in the file order) to the clone cells.
+    # It is built only once for every netcdf grid, clone map and method (regridcache). regridMethod:
+    # - "nearest"     : every clone cell gets the value of the netcdf cell containing its centre
+    # - "conservative": the area weighted average of the netcdf cells overlapping the clone cell
+    # Unlike regridData2FinerGrid, the cell size ratio does not need to be an integer. (Longitudes are not wrapped.)
+    if sparse == None: raise ImportError("scipy is needed for the regridding operator (regridMethod: "+str(regridMethod)+").")
+    if regridMethod not in ["nearest", "conservative"]: raise ValueError("Unknown regridMethod: "+str(regridMethod))
+
+    lat = np.asarray(f.variables['lat'][:], dtype = np.float64)
+    lon = np.asarray(f.variables['lon'][:], dtype = np.float64)
+    cacheKey = ('grid', len(lat), lat[0], lat[-1], len(lon), lon[0], lon[-1], cloneMapFileName, regridMethod)
+    if cacheKey in regridcache.keys(): return regridcache[cacheKey]
+
+    logger.debug('Building the '+str(regridMethod)+' regridding operator of the file '+str(ncFile)+' to the clone map '+str(cloneMapFileName))
+    attributeClone = getMapAttributesALL(cloneMapFileName)
+    rowsClone = int(attributeClone['rows']) ; colsClone = int(attributeClone['cols'])
+    cloneY = attributeClone['yUL'] - attributeClone['cellsize'] * np.arange(rowsClone + 1)     # cell edges, north to south
+    cloneX = attributeClone['xUL'] + attributeClone['cellsize'] * np.arange(colsClone + 1)     # cell edges, west to east
+
+    # cell edges of the netcdf grid (file order)
+    dy = abs(lat[1] - lat[0]) ; dx = abs(lon[1] - lon[0])
+    latN = lat + 0.5 * dy ; latS = lat - 0.5 * dy
+    lonW = lon - 0.5 * dx ; lonE = lon + 0.5 * dx
+
+    # window: the netcdf rows and columns overlapping the clone map
+    rowsIn = np.flatnonzero((latS < cloneY[0]) & (latN > cloneY[-1]))
+    colsIn = np.flatnonzero((lonW < cloneX[-1]) & (lonE > cloneX[0]))
+    if len(rowsIn) == 0 or len(colsIn) == 0: raise ValueError("The netcdf file "+str(ncFile)+" does not cover the clone map "+str(cloneMapFileName))
+    rowSta = int(rowsIn.min()) ; rowEnd = int(rowsIn.max()) + 1
+    colSta = int(colsIn.min()) ; colEnd = int(colsIn.max()) + 1
+    latN = latN[rowSta:rowEnd] ; latS = latS[rowSta:rowEnd]
+    lonW = lonW[colSta:colEnd] ; lonE = lonE[colSta:colEnd]
+
+    # weights in the y and x directions (clone rows x window rows ; clone columns x window columns)
+    if regridMethod == "nearest":
+        centreY = 0.5 * (cloneY[:-1] + cloneY[1:]) ; centreX = 0.5 * (cloneX[:-1] + cloneX[1:])
+        weightY = ((latS[np.newaxis,:] <= centreY[:,np.newaxis]) & (centreY[:,np.newaxis] < latN[np.newaxis,:])).astype(np.float64)
+        weightX = ((lonW[np.newaxis,:] <= centreX[:,np.newaxis]) & (centreX[:,np.newaxis] < lonE[np.newaxis,:])).astype(np.float64)
+        # - a centre in more than one cell (overlapping netcdf cells): use the first one
+        weightY[np.cumsum(weightY, axis = 1) > 1] = 0.0
+        weightX[np.cumsum(weightX, axis = 1) > 1] = 0.0
+    else:
+        # overlapping area (on a sphere: proportional to the longitude overlap times the difference of sin(latitude))
+        north = np.minimum(cloneY[:-1,np.newaxis], latN[np.newaxis,:])
+        south = np.maximum(cloneY[1:, np.newaxis], latS[np.newaxis,:])
+        weightY = np.where(north > south, np.sin(np.radians(north)) - np.sin(np.radians(south)), 0.0)
+        east = np.minimum(cloneX[1:, np.newaxis], lonE[np.newaxis,:])
+        west = np.maximum(cloneX[:-1,np.newaxis], lonW[np.newaxis,:])
+        weightX = np.where(east > west, east - west, 0.0)
+    regridMatrix = sparse.kron(sparse.csr_matrix(weightY), sparse.csr_matrix(weightX), format = 'csr')
+
+    regridOperator = {'matrix': regridMatrix,\
+                      'shape' : (rowsClone, colsClone),\
+                      'window': {'flip'  : False,\
+                                 'rows'  : (rowSta, rowEnd),\
+                                 'cols'  : (colSta, colEnd),\
+                                 'factor': 1}}
+    regridcache[cacheKey] = regridOperator
+    return regridOperator
+
+def applyRegridOperator(regridOperator, cropData, cells = None, out = None):
+    # To resample a field or a series of fields (the last two axes: the window of the regridding operator, with MV 
+    # for missing values) to the clone map. The weighted values and the weights of the valid cells are calculated 
+    # with sparse matrix products; clone cells without valid netcdf cells get MV.
+    # With cells (flat indexes of clone cells, e.g. the active cells of a catchment), only the operator rows of these 
+    # cells are applied and the result has these cells as its last axis (instead of the rows and columns of the clone).
+    # With out (an array of the shape of the result), the result is written into it.
+    matrix   = regridOperator['matrix']
+    if cells is not None: matrix = matrix[np.asarray(cells)]
+    cropData = np.asarray(cropData, dtype = np.float64)
+    leading  = cropData.shape[:-2]
+    values   = cropData.reshape((-1, cropData.shape[-2] * cropData.shape[-1]))             # fields x window cells
+    valid    = values != MV
+    weights  = np.asarray(matrix.dot(valid.T.astype(np.float64)).T)
+    outData  = np.asarray(matrix.dot(np.where(valid, values, 0.0).T).T)
+    np.divide(outData, weights, out = outData, where = weights > 0.0)
+    outData[weights <= 0.0] = MV
+    if cells is not None: 
+        shape = leading + (matrix.shape[0],)
+    else:
+        shape = leading + regridOperator['shape']
+    if out is None: return outData.reshape(shape)
+    out[...] = outData.reshape(shape)
+    return out
+
+def getNCTimeIndexOfDate(ncFile, f, varName, dateInput, useDoy = None):
+    # time index (in the netCDF file) of a date (string 'YYYY-MM-DD' or datetime)
     date = dateInput
     if useDoy == "Yes": 
         idx = dateInput - 1
@@ -222,53 +523,161 @@ def netcdf2PCRobjClone(ncFile,varName,dateInput,\
         if useDoy == "month":
             idx = int(date.month) - 1
         else:
-            nctime = f.variables['time']  # A netCDF time variable object.
-            if useDoy == "yearly":
-                date  = datetime.datetime(date.year,int(1),int(1))
-            if useDoy == "monthly":
-                date = datetime.datetime(date.year,date.month,int(1))
-            if useDoy == "yearly" or useDoy == "monthly":
-                # if the desired year is not available, use the first year or the last year that is available
-                first_year_in_nc_file = findFirstYearInNCTime(nctime)
-                last_year_in_nc_file  =  findLastYearInNCTime(nctime)
-                #
-                if date.year < first_year_in_nc_file:  
-                    date = datetime.datetime(first_year_in_nc_file,date.month,date.day)
-                    msg  = "\n"
-                    msg += "WARNING related to the netcdf file: "+str(ncFile)+" ; variable: "+str(varName)+" !!!!!!"+"\n"
-                    msg += "The date "+str(dateInput)+" is NOT available. "
-                    msg += "The date "+str(date.year)+"-"+str(date.month)+"-"+str(date.day)+" is used."
-                    msg += "\n"
-                    logger.warning(msg)
-                if date.year > last_year_in_nc_file:  
-                    date = datetime.datetime(last_year_in_nc_file,date.month,date.day)
-                    msg  = "\n"
-                    msg += "WARNING related to the netcdf file: "+str(ncFile)+" ; variable: "+str(varName)+" !!!!!!"+"\n"
-                    msg += "The date "+str(dateInput)+" is NOT available. "
-                    msg += "The date "+str(date.year)+"-"+str(date.month)+"-"+str(date.day)+" is used."
-                    msg += "\n"
-                    logger.warning(msg)
-            try:
-                idx = nc.date2index(date, nctime, calendar = nctime.calendar, \
-                                                  select='exact')
-            except:                                  
-                try:
-                    idx = nc.date2index(date, nctime, calendar = nctime.calendar, \
-                                                      select='before')
-                    msg  = "\n"
-                    msg += "WARNING related to the netcdf file: "+str(ncFile)+" ; variable: "+str(varName)+" !!!!!!"+"\n"
-                    msg += "The date "+str(dateInput)+" is NOT available. The 'before' option is used while selecting netcdf time."
-                    msg += "\n"
-                except:
-                    idx = nc.date2index(date, nctime, calendar = nctime.calendar, \
-                                                      select='after')
-                    msg  = "\n"
-                    msg += "WARNING related to the netcdf file: "+str(ncFile)+" ; variable: "+str(varName)+" !!!!!!"+"\n"
-                    msg += "The date "+str(dateInput)+" is NOT available. The 'after' option is used while selecting netcdf time."
-                    msg += "\n"
-                logger.warning(msg)
-                                                  
-    idx = int(idx)                                                  
+            # the time axis is decoded only once per file (see getNCTimeTable)
+            timeTable = getNCTimeTable(ncFile, f.variables['time'])
+            idx = getNCTimeIndex(timeTable, date, useDoy, ncFile, varName, dateInput)
+    return int(idx)
+
+def isNCFileSeries(ncFile):
+    # a list of netcdf files or a file name pattern with %Y (yearly files), see getNCFileName
+    return isinstance(ncFile, (list, tuple)) or '%Y' in str(ncFile)
+
+def getDateTime(dateInput):
+    # datetime.datetime (without hours) of a date (string 'YYYY-MM-DD', datetime.date or datetime.datetime)
+    if isinstance(dateInput, str): dateInput = datetime.datetime.strptime(str(dateInput),'%Y-%m-%d')
+    return datetime.datetime(dateInput.year, dateInput.month, dateInput.day)
+
+def getNCFileName(ncFile, dateInput):
+    # To route a date to the netcdf file containing it. ncFile: a netcdf file name, a file name pattern with %Y 
+    # for yearly files (e.g. ..._Runoff_%Y.nc) or a list of netcdf files (in chronological order).
+    # - With a list, the time axis of every file is decoded only once (see getNCTimeTable). Dates before/after 
+    #   all files are routed to the first/last file (see getNCTimeIndex for the 'before'/'after' selection). 
+    if not isNCFileSeries(ncFile): return ncFile
+    date = getDateTime(dateInput)
+    if not isinstance(ncFile, (list, tuple)):
+        return ncFile.replace('%Y', '%04i' % date.year)
+    for fileName in ncFile:
+        if fileName in timecache.keys():
+            timeTable = timecache[fileName]
+        else:
+            timeTable = getNCTimeTable(fileName, filecache.get(fileName).variables['time'])
+        if date <= timeTable['last_date']: break
+    return fileName
+
+def openNextNCFile(ncFile, dateInput, cloneMapFileName = None):
+    # To open the next file of a file series (see getNCFileName) ahead of time, ncLookaheadDays before the date
+    # reaches it. Its time axis and crop window are also prepared (the window of the previous file is reused if
+    # the grid is the same, see getNCCloneWindow).
+    date = getDateTime(dateInput)
+    nextFile = getNCFileName(ncFile, date + datetime.timedelta(days = ncLookaheadDays))
+    if nextFile == getNCFileName(ncFile, date) or nextFile in filecache or not os.path.isfile(nextFile): return
+    logger.debug('Opening the next netcdf file: '+str(nextFile))
+    f = filecache.get(nextFile)
+    getNCTimeTable(nextFile, f.variables['time'])
+    getNCCloneWindow(nextFile, f, cloneMapFileName)
+
+def getNCTimeTable(ncFile, nctime):
+    # To decode the time axis of a netcdf file only once; the table is kept in timecache.
+    if ncFile not in timecache.keys():
+        times    = np.asarray(nctime[:], dtype = np.float64)
+        calendar = getattr(nctime, 'calendar', 'standard')
+        timeTable = {}
+        timeTable['times']      = times
+        timeTable['units']      = nctime.units
+        timeTable['calendar']   = calendar
+        timeTable['first_year'] = findFirstYearInNCTime(nctime)
+        timeTable['last_year']  = findLastYearInNCTime(nctime)
+        timeTable['is_sorted']  = bool(np.all(np.diff(times) > 0))
+        timeTable['file']       = ncFile
+        # first and last dates (datetime.datetime, without hours) in the file
+        firstLast = nc.num2date(times[[0,-1]], nctime.units, calendar)
+        timeTable['first_date'] = datetime.datetime(firstLast[0].year, firstLast[0].month, firstLast[0].day)
+        timeTable['last_date']  = datetime.datetime(firstLast[1].year, firstLast[1].month, firstLast[1].day)
+        # time indexes that have been looked up (key: date and useDoy)
+        timeTable['index']      = {}
+        if not timeTable['is_sorted']:
+            logger.warning("The time axis of the netcdf file "+str(ncFile)+" is not sorted. 'nc.date2index' is used.")
+        timecache[ncFile] = timeTable
+    return timecache[ncFile]
+
+def findNCTimeIndex(timeTable, date, select = 'exact'):
+    # Binary search of a date in a time table; select: 'exact', 'before' or 'after' (as in nc.date2index). 
+    # Returns None if the date cannot be found.
+    if not timeTable['is_sorted']:
+        try:
+            nctime = filecache.get(timeTable['file']).variables['time']
+            return int(nc.date2index(date, nctime, calendar = timeTable['calendar'], select = select))
+        except:
+            return None
+    times = timeTable['times']
+    value = nc.date2num(date, timeTable['units'], timeTable['calendar'])
+    if select == 'exact':
+        idx = int(np.searchsorted(times, value, side = 'left'))
+        if idx < len(times) and times[idx] == value: return idx
+        return None
+    if select == 'before':
+        idx = int(np.searchsorted(times, value, side = 'right')) - 1
+        if idx >= 0: return idx
+        return None
+    if select == 'after':
+        idx = int(np.searchsorted(times, value, side = 'left'))
+        if idx < len(times): return idx
+        return None
+
+def warnNCTime(ncFile, varName, dateInput, message, warningType):
+    # The same type of warning is given only once for every file and variable. 
+    msg  = "\n"
+    msg += "WARNING related to the netcdf file: "+str(ncFile)+" ; variable: "+str(varName)+" !!!!!!"+"\n"
+    msg += "The date "+str(dateInput)+" is NOT available. "+message
+    msg += "\n"
+    warningKey = (ncFile, varName, warningType)
+    if warningKey in warnedtimes:
+        logger.debug(msg)
+    else:
+        warnedtimes.add(warningKey)
+        logger.warning(msg + "(Further warnings of this type for this file are given at the debug level.)\n")
+
+def getNCTimeIndex(timeTable, date, useDoy, ncFile, varName, dateInput):
+    # time index of a date (datetime.datetime) using a time table (see getNCTimeTable) 
+    indexKey = (date, useDoy)
+    if indexKey in timeTable['index']: return timeTable['index'][indexKey]
+
+    if useDoy == "yearly":
+        date  = datetime.datetime(date.year,int(1),int(1))
+    if useDoy == "monthly":
+        date = datetime.datetime(date.year,date.month,int(1))
+    if useDoy == "yearly" or useDoy == "monthly":
+        # if the desired year is not available, use the first year or the last year that is available
+        first_year_in_nc_file = timeTable['first_year']
+        last_year_in_nc_file  = timeTable['last_year']
+        #
+        if date.year < first_year_in_nc_file:  
+            date = datetime.datetime(first_year_in_nc_file,date.month,date.day)
+            warnNCTime(ncFile, varName, dateInput, "The date "+str(date.year)+"-"+str(date.month)+"-"+str(date.day)+" is used.", 'first_year')
+        if date.year > last_year_in_nc_file:  
+            date = datetime.datetime(last_year_in_nc_file,date.month,date.day)
+            warnNCTime(ncFile, varName, dateInput, "The date "+str(date.year)+"-"+str(date.month)+"-"+str(date.day)+" is used.", 'last_year')
+    
+    idx = findNCTimeIndex(timeTable, date, 'exact')
+    if idx == None:
+        idx = findNCTimeIndex(timeTable, date, 'before')
+        if idx != None:
+            warnNCTime(ncFile, varName, dateInput, "The 'before' option is used while selecting netcdf time.", 'before')
+        else:
+            idx = findNCTimeIndex(timeTable, date, 'after')
+            if idx == None:
+                raise ValueError("The date "+str(dateInput)+" cannot be found in the netcdf file: "+str(ncFile))
+            warnNCTime(ncFile, varName, dateInput, "The 'after' option is used while selecting netcdf time.", 'after')
+    
+    timeTable['index'][indexKey] = idx
+    return idx
+
+def getNCCloneWindow(ncFile, f, cloneMapFileName = None):
+    # To resolve the orientation of a netcdf file and the row/column index ranges (in the file) 
+    # covering the clone map. This is done only once for every netcdf file and clone map (windowcache).
+    cacheKey = (ncFile, cloneMapFileName)
+    if cacheKey in windowcache.keys(): return windowcache[cacheKey]
+
+    lat = f.variables['lat'][:]
+    lon = f.variables['lon'][:]
+
+    # files with the same grid (e.g. yearly files, see getNCFileName) share the window
+    gridKey = ('grid', len(lat), float(lat[0]), float(lat[-1]), len(lon), float(lon[0]), float(lon[-1]), cloneMapFileName)
+    if gridKey in windowcache.keys():
+        windowcache[cacheKey] = windowcache[gridKey]
+        return windowcache[cacheKey]
+    rowsFile = len(lat)
+    colsFile = len(lon)
 
     # check the orientation of the latitude and flip it if necessary
     we_have_to_flip = False
@@ -300,44 +709,176 @@ def netcdf2PCRobjClone(ncFile,varName,dateInput,\
         if xULClone != xULInput: sameClone = False
         if yULClone != yULInput: sameClone = False
 
-    cropData = f.variables[varName][int(idx),:,:]       # still original data
-    factor = 1                          # needed in regridData2FinerGrid
-
-    # flip if necessary 
-    if we_have_to_flip: cropData = cropData[::-1,:]
-
+    # window (north to south) - by default: the entire field 
+    yIdxSta = 0 ; yIdxEnd = rowsFile
+    xIdxSta = 0 ; xIdxEnd = colsFile
+    factor  = 1
     if sameClone == False:
         
         logger.debug('Crop to the clone map with lower left corner (x,y): '+str(xULClone)+' , '+str(yULClone))
 
-        #~ print('Crop to the clone map with lower left corner (x,y): '+str(xULClone)+' , '+str(yULClone))
-
         # crop to cloneMap:
         minX    = min(abs(lon[:] - (xULClone + 0.5*cellsizeInput))) # ; print(minX)
-        xIdxSta = int(np.where(abs(lon[:] - (xULClone + 0.5*cellsizeInput)) == minX)[0])
+        xIdxSta = int(np.where(abs(lon[:] - (xULClone + 0.5*cellsizeInput)) == minX)[0][0])
         xIdxEnd = int(math.ceil(xIdxSta + colsClone /(cellsizeInput/cellsizeClone)))
         minY    = min(abs(lat[:] - (yULClone - 0.5*cellsizeInput))) # ; print(minY)
-        yIdxSta = int(np.where(abs(lat[:] - (yULClone - 0.5*cellsizeInput)) == minY)[0])
+        yIdxSta = int(np.where(abs(lat[:] - (yULClone - 0.5*cellsizeInput)) == minY)[0][0])
         yIdxEnd = int(math.ceil(yIdxSta + rowsClone /(cellsizeInput/cellsizeClone)))
-        cropData = cropData[yIdxSta:yIdxEnd,xIdxSta:xIdxEnd]
+        xIdxEnd = min(xIdxEnd, colsFile)
+        yIdxEnd = min(yIdxEnd, rowsFile)
 
         factor = int(round(float(cellsizeInput)/float(cellsizeClone)))
         if factor > 1: logger.debug('Resample: input cell size = '+str(float(cellsizeInput))+' ; output/clone cell size = '+str(float(cellsizeClone)))
 
-    # convert to PCR object and close f
-    if specificFillValue != None:
-        outPCR = pcr.numpy2pcr(pcr.Scalar, \
-                  regridData2FinerGrid(factor,cropData,MV), \
-                  float(specificFillValue))
+    # row indexes in the file (if the file is flipped, the rows are counted from the south)
+    if we_have_to_flip: yIdxSta, yIdxEnd = rowsFile - yIdxEnd, rowsFile - yIdxSta
+
+    window = {'flip'  : we_have_to_flip,\
+              'rows'  : (yIdxSta, yIdxEnd),\
+              'cols'  : (xIdxSta, xIdxEnd),\
+              'factor': factor}
+    windowcache[cacheKey] = window
+    windowcache[gridKey]  = window
+    return window
+
+def getTimeSlabSize(ncVariable, timeSlabSize = "auto"):
+    # number of time steps read in one call; "auto": the chunk size of the time dimension
+    if timeSlabSize == "auto":
+        chunking = ncVariable.chunking()
+        if chunking == None or chunking == 'contiguous': return 1
+        return max(1, int(chunking[0]))
+    return max(1, int(timeSlabSize))
+
+def readNetCDFTimeSlab(ncFile, f, varName, idx, timeSlabSize = None, window = None):
+    # To read the field at the time index idx (only the rows and columns of the window, see getNCCloneWindow).  
+    # If timeSlabSize is given, a block of consecutive time steps (starting from idx) is read in one call and 
+    # kept in slabcache, so that the following time steps are served from memory (without decompressing 
+    # the same netcdf chunks again). 
+    rows = slice(None) ; cols = slice(None)
+    if window != None:
+        rows = slice(window['rows'][0], window['rows'][1])
+        cols = slice(window['cols'][0], window['cols'][1])
+
+    if timeSlabSize == None:
+        data = f.variables[varName][idx,rows,cols]
+        instrumentation.count("netcdf bytes read: " + str(ncFile), data.nbytes)
+        return data
+    
+    # - only one slab is kept for every variable and window (also if the file changes, see getNCFileName)
+    cacheKey = (varName, rows.start, rows.stop, cols.start, cols.stop)
+    if cacheKey in slabcache.keys():
+        slabFile, slabStaIdx, slab = slabcache[cacheKey]
+        if slabFile == ncFile and slabStaIdx <= idx < slabStaIdx + len(slab):
+            instrumentation.count("slabcache hits")
+            return slab[idx - slabStaIdx]
+    
+    ncVariable = f.variables[varName]
+    slabSize   = getTimeSlabSize(ncVariable, timeSlabSize)
+    slabStaIdx = idx
+    # - "auto": align the slab to the netcdf chunks
+    if timeSlabSize == "auto": slabStaIdx = (idx // slabSize) * slabSize
+    slabEndIdx = min(slabStaIdx + slabSize, ncVariable.shape[0])
+    logger.debug('reading the time steps '+str(slabStaIdx)+' to '+str(slabEndIdx - 1)+' of the variable: '+str(varName)+' from the file: '+str(ncFile))
+    slab = ncVariable[slabStaIdx:slabEndIdx,rows,cols]
+    instrumentation.count("netcdf bytes read: " + str(ncFile), slab.nbytes)
+    instrumentation.count("slabcache misses")
+    slabcache[cacheKey] = (ncFile, slabStaIdx, slab)
+    return slab[idx - slabStaIdx]
+
+def netcdf2NumpyCloneSeries(ncFile,varName,dates,\
+                            cloneMapFileName  = None,\
+                            specificFillValue = None,\
+                            regridMethod      = None,\
+                            regridCells       = None,\
+                            out               = None):
+    # 
+    # To read the fields of several dates in one call, only within the clone window and at the input resolution. 
+    # Returns an array (number of dates, rows, cols) with MV for missing values and the factor 
+    # needed to resample it to the clone map (see regridData2FinerGrid).
+    # For a file series (see getNCFileName), the dates of every file are read separately.
+    # With regridMethod (see getRegridOperator), the fields are resampled to the clone map (the factor is 1).
+    # With regridCells (flat indexes of clone cells, e.g. the active cells of catchments), only these cells are 
+    # resampled: the result is (number of dates, number of cells) instead of full clone fields.
+    # With out (a float64 array of the shape of the result, see getNCCloneSeriesShape; e.g. a np.memmap shared with 
+    # other processes), the fields are written into it instead of a new array.
+    #
+    if isNCFileSeries(ncFile):
+        fileNames = [getNCFileName(ncFile, date) for date in dates]
+        cropData = [] ; i = 0
+        while i < len(dates):
+            j = i
+            while j < len(dates) and fileNames[j] == fileNames[i]: j += 1
+            fileData, factor = netcdf2NumpyCloneSeries(fileNames[i], varName, dates[i:j], cloneMapFileName, specificFillValue, regridMethod, regridCells, \
+                                                       out = None if out is None else out[i:j])
+            cropData.append(fileData) ; i = j
+        if out is not None: return out, factor
+        return np.concatenate(cropData, axis = 0), factor
+
+    logger.debug('reading variable: '+str(varName)+' for '+str(len(dates))+' dates from the file: '+str(ncFile))
+    
+    f = filecache.get(ncFile)
+    
+    varName = str(varName)
+
+    # time indexes (in the netCDF file)
+    with instrumentation.stage("netcdf: time index"):
+        idxs = np.array([getNCTimeIndexOfDate(ncFile, f, varName, date) for date in dates], dtype = np.int64)
+
+    # crop window (and orientation) of the netcdf file on the clone map
+    if regridMethod != None:
+        regridOperator = getRegridOperator(ncFile, f, cloneMapFileName, regridMethod)
+        window = regridOperator['window']
     else:
-        outPCR = pcr.numpy2pcr(pcr.Scalar, \
-                  regridData2FinerGrid(factor,cropData,MV), \
-                  float(f.variables[varName]._FillValue))
-                  
-    #f.close();
-    f = None ; cropData = None 
-    # PCRaster object
-    return (outPCR)
+        window = getNCCloneWindow(ncFile, f, cloneMapFileName)
+    rows = slice(window['rows'][0], window['rows'][1])
+    cols = slice(window['cols'][0], window['cols'][1])
+
+    # read all time steps between the first and the last index in one call
+    staIdx = int(idxs.min()) ; endIdx = int(idxs.max()) + 1
+    with instrumentation.stage("netcdf: read"):
+        cropData = f.variables[varName][staIdx:endIdx,rows,cols]
+    instrumentation.count("netcdf bytes read: " + str(ncFile), cropData.nbytes)
+    cropData = cropData[idxs - staIdx]
+
+    with instrumentation.stage("netcdf: crop and missing values"):
+        # flip if necessary 
+        if window['flip']: cropData = cropData[:,::-1,:]
+
+        # set missing values to MV
+        if specificFillValue != None:
+            missingValue = float(specificFillValue)
+        else:
+            missingValue = float(f.variables[varName]._FillValue)
+        if out is None or regridMethod != None:
+            fieldData = np.empty(cropData.shape, dtype = np.float64)
+        else:
+            fieldData = out
+        fieldData[...] = np.ma.filled(cropData)
+        fieldData[fieldData == missingValue] = MV
+        cropData = fieldData
+    
+    if regridMethod != None:
+        with instrumentation.stage("regrid operator"):
+            cropData = applyRegridOperator(regridOperator, cropData, regridCells, out)
+    return cropData, window['factor']
+
+def getTimeBlockSize(timeSlabSize = None, defaultSize = 365):
+    # The number of time steps read and reduced at once by the block engines (see netcdf2NumpyCloneSeries): 
+    # timeSlabSize if it is a number of time steps, otherwise (e.g. None or "auto") defaultSize.
+    if isinstance(timeSlabSize, int): return max(1, timeSlabSize)
+    return defaultSize
+
+def getNCCloneSeriesShape(ncFile, dates, cloneMapFileName = None, regridMethod = None, regridCells = None):
+    # The shape and factor of the result of netcdf2NumpyCloneSeries, without reading the fields (e.g. to create 
+    # its out array). For a file series (see getNCFileName), the files share the grid of the first one.
+    ncFile = getNCFileName(ncFile, dates[0]) if isNCFileSeries(ncFile) else ncFile
+    f = filecache.get(ncFile)
+    if regridMethod != None:
+        regridOperator = getRegridOperator(ncFile, f, cloneMapFileName, regridMethod)
+        if regridCells is not None: return (len(dates), len(regridCells)), 1
+        return (len(dates),) + tuple(regridOperator['shape']), 1
+    window = getNCCloneWindow(ncFile, f, cloneMapFileName)
+    return (len(dates), window['rows'][1] - window['rows'][0], window['cols'][1] - window['cols'][0]), window['factor']
 
 def netcdf2PCRobjCloneWindDist(ncFile,varName,dateInput,useDoy = None,
                        cloneMapFileName=None):
@@ -347,8 +888,8 @@ def netcdf2PCRobjCloneWindDist(ncFile,varName,dateInput,useDoy = None,
     #     Only works if cells are 'square'.
     #     Only works if cellsizeClone <= cellsizeInput
     
-    # Get netCDF file and variable name:
-    f = nc.Dataset(ncFile)
+    # Get netCDF file (see filecache) and variable name:
+    f = filecache.get(ncFile)
     varName = str(varName)
 
     # date
@@ -400,11 +941,10 @@ def netcdf2PCRobjCloneWindDist(ncFile,varName,dateInput,useDoy = None,
         cropData = f.variables[varName][idx,yIdxSta:yIdxEnd,xIdxSta:xIdxEnd]
         factor = int(float(cellsizeInput)/float(cellsizeClone))
     
-    # convert to PCR object and close f
+    # convert to PCR object
     outPCR = pcr.numpy2pcr(pcr.Scalar, \
                regridData2FinerGrid(factor,cropData,MV), \
                   float(0.0))
-    f.close();
     f = None ; cropData = None 
     # PCRaster object
     return (outPCR)    
@@ -417,8 +957,8 @@ def netcdf2PCRobjCloneWind(ncFile,varName,dateInput,useDoy = None,
     #     Only works if cells are 'square'.
     #     Only works if cellsizeClone <= cellsizeInput
     
-    # Get netCDF file and variable name:
-    f = nc.Dataset(ncFile)
+    # Get netCDF file (see filecache) and variable name:
+    f = filecache.get(ncFile)
     varName = str(varName)
 
     # date
@@ -469,11 +1009,10 @@ def netcdf2PCRobjCloneWind(ncFile,varName,dateInput,useDoy = None,
         cropData = f.variables[varName][idx,yIdxSta:yIdxEnd,xIdxSta:xIdxEnd]
         factor = int(float(cellsizeInput)/float(cellsizeClone))
     
-    # convert to PCR object and close f
+    # convert to PCR object
     outPCR = pcr.numpy2pcr(pcr.Scalar, \
                regridData2FinerGrid(factor,cropData,MV), \
                   float(f.variables[varName]._FillValue))
-    f.close();
     f = None ; cropData = None 
     # PCRaster object
     return (outPCR)    
@@ -482,8 +1021,8 @@ def netcdf2PCRobj(ncFile,varName,dateInput):
     # EHS (04 APR 2013): To convert netCDF (tss) file to PCR file.
     # The cloneMap is globally defined (outside this method).
     
-    # Get netCDF file and variable name:
-    f = nc.Dataset(ncFile)
+    # Get netCDF file (see filecache) and variable name:
+    f = filecache.get(ncFile)
     varName = str(varName)
 
     # date
@@ -497,10 +1036,10 @@ def netcdf2PCRobj(ncFile,varName,dateInput):
     idx = nc.date2index(date, nctime, calendar=nctime.calendar, \
                                                  select='exact') 
     
-    # convert to PCR object and close f
+    # convert to PCR object
     outPCR = pcr.numpy2pcr(pcr.Scalar,(f.variables[varName][idx].data), \
                              float(f.variables[varName]._FillValue))
-    f.close(); f = None ; del f
+    f = None ; del f
     # PCRaster object
     return (outPCR)
 
@@ -518,9 +1057,9 @@ def writePCRmapToDir(v,outFileName,outDir):
     pcr.report(v,fullFileName)
 
 def readPCRmapClone(v,cloneMapFileName,tmpDir,absolutePath=None,isLddMap=False,cover=None,isNomMap=False,inputEPSG="EPSG:4326",outputEPSG="EPSG:4326",method="near"):
-	# v: inputMapFileName or floating values
-	# cloneMapFileName: If the inputMap and cloneMap have different clones,
-	#                   resampling will be done.   
+    # v: inputMapFileName or floating values
+    # cloneMapFileName: If the inputMap and cloneMap have different clones,
+    #                   resampling will be done.
     logger.debug('read file/values: '+str(v))
     if v == "None":
         PCRmap = str("None")
@@ -530,9 +1069,24 @@ def readPCRmapClone(v,cloneMapFileName,tmpDir,absolutePath=None,isLddMap=False,c
         sameClone = isSameClone(v,cloneMapFileName)
         if sameClone == True:
             PCRmap = pcr.readmap(v)
+        elif gdal != None:
+            # resample using GDAL (in memory, without temporary files):
+            if inputEPSG == outputEPSG or outputEPSG == None: 
+                data, missingValue = gdalwarpNumpy(v,cloneMapFileName,isLddMap,isNomMap)
+            else:
+                data, missingValue = gdalwarpNumpy(v,cloneMapFileName,isLddMap,isNomMap,inputEPSG,outputEPSG,method)
+            if isLddMap == True or isNomMap == True:
+                PCRmap = pcr.numpy2pcr(pcr.Nominal, data, missingValue)
+            else:
+                PCRmap = pcr.numpy2pcr(pcr.Scalar, data, missingValue)
+            if isLddMap == True: PCRmap = pcr.ifthen(pcr.scalar(PCRmap) < 10., PCRmap)
+            if isLddMap == True: PCRmap = pcr.ldd(PCRmap)
+            if isNomMap == True: PCRmap = pcr.ifthen(pcr.scalar(PCRmap) >  0., PCRmap)
+            if isNomMap == True: PCRmap = pcr.nominal(PCRmap)
         else:
             # resample using GDAL:
-            output = tmpDir+'temp.map'
+            # - only the temporary files of this call are removed (tmpDir may be shared, see workspace)
+            output = os.path.join(tmpDir, 'temp_'+get_random_word(8)+'.map')
             # if no re-projection needed:
             if inputEPSG == outputEPSG or outputEPSG == None: 
                 warp = gdalwarpPCR(v,output,cloneMapFileName,tmpDir,isLddMap,isNomMap)
@@ -544,9 +1098,7 @@ def readPCRmapClone(v,cloneMapFileName,tmpDir,absolutePath=None,isLddMap=False,c
             if isLddMap == True: PCRmap = pcr.ldd(PCRmap)
             if isNomMap == True: PCRmap = pcr.ifthen(pcr.scalar(PCRmap) >  0., PCRmap)
             if isNomMap == True: PCRmap = pcr.nominal(PCRmap)
-            if os.path.isdir(tmpDir):
-                shutil.rmtree(tmpDir)
-            os.makedirs(tmpDir)
+            os.remove(output)
     else:
         PCRmap = pcr.scalar(float(v))
     if cover != None:
@@ -558,7 +1110,7 @@ def readPCRmapClone(v,cloneMapFileName,tmpDir,absolutePath=None,isLddMap=False,c
     return PCRmap    
 
 def readPCRmap(v):
-	# v : fileName or floating values
+    # v : fileName or floating values
     if not re.match(r"[0-9.-]*$", v):
         PCRmap = pcr.readmap(v)
     else:
@@ -589,22 +1141,79 @@ def isSameClone(inputMapFileName,cloneMapFileName):
     if yULClone != yULInput: sameClone = False
     return sameClone
 
+def getGdalwarpOptions(isLddMap=False,isNominalMap=False,inputEPSG="default",outputEPSG="default",method="default"):
+    # gdal.Warp options equivalent to the gdal_translate/gdalwarp command lines in gdalwarpPCR
+    warpOptions = {'outputType': gdal.GDT_Float32, \
+                   'srcNodata' : -3.4028234663852886e+38, \
+                   'dstNodata' : -3.4028234663852886e+38}
+    if isLddMap == True or isNominalMap == True: 
+        warpOptions = {'outputType': gdal.GDT_Int32}
+    if inputEPSG != "default" or outputEPSG != "default" or method != "default":
+        warpOptions['srcSRS'] = inputEPSG
+        warpOptions['dstSRS'] = outputEPSG
+        warpOptions['resampleAlg'] = method
+    return warpOptions
+
+def gdalWarpInMemory(input,cloneOut,pcrOutput=None,**warpOptions):
+    # To warp a raster file to the extent and resolution of the clone map with the GDAL python bindings. 
+    # The output is kept in memory (/vsimem/). Returns the array and its missing value (None if not defined).
+    # With pcrOutput, the result is (only) written to this PCRaster map.
+    cloneAtt = getMapAttributesALL(cloneOut)
+    xmin = cloneAtt['xUL']
+    ymin = cloneAtt['yUL'] - cloneAtt['rows']*cloneAtt['cellsize']
+    xmax = cloneAtt['xUL'] + cloneAtt['cols']*cloneAtt['cellsize']
+    ymax = cloneAtt['yUL'] 
+    # - unique name, so that several warps can run at the same time
+    vsimemFile = '/vsimem/' + get_random_word(16) + '.tif'
+    logger.debug('Warp (in memory) the file '+str(input)+' to the clone map '+str(cloneOut))
+    data = None ; missingValue = None
+    try:
+        ds = gdal.Warp(vsimemFile, str(input), format = 'GTiff', \
+                       outputBounds = (xmin, ymin, xmax, ymax), \
+                       width = int(cloneAtt['cols']), height = int(cloneAtt['rows']), **warpOptions)
+        if pcrOutput != None:
+            gdal.Translate(str(pcrOutput), ds, format = 'PCRaster')
+        else:
+            band = ds.GetRasterBand(1)
+            data = band.ReadAsArray()
+            missingValue = band.GetNoDataValue()
+            band = None
+        ds = None
+    finally:
+        gdal.Unlink(vsimemFile)
+    return data, missingValue
+
+def gdalwarpNumpy(input,cloneOut,isLddMap=False,isNominalMap=False,inputEPSG="default",outputEPSG="default",method="default"):
+    # In-process version of gdalwarpPCR: returns the warped array (and its missing value) instead of writing a PCRaster map.
+    warpOptions = getGdalwarpOptions(isLddMap,isNominalMap,inputEPSG,outputEPSG,method)
+    data, missingValue = gdalWarpInMemory(input, cloneOut, **warpOptions)
+    if missingValue == None: missingValue = int(np.iinfo(np.int32).min)
+    return data, missingValue
+
 def gdalwarpPCR(input,output,cloneOut,tmpDir,isLddMap=False,isNominalMap=False,inputEPSG="default",outputEPSG="default",method="default"):
     # 19 Mar 2013 created by Edwin H. Sutanudjaja
     # all input maps must be in PCRaster maps
     # 
-    # remove temporary files:
-    co = 'rm '+str(tmpDir)+'*.*'
-    cOut,err = subprocess.Popen(co, stdout=subprocess.PIPE,stderr=open(os.devnull),shell=True).communicate()
+    if gdal != None:
+        # in-process: warp in memory and write the PCRaster map directly (no temporary files and subprocesses)
+        warpOptions = getGdalwarpOptions(isLddMap,isNominalMap,inputEPSG,outputEPSG,method)
+        gdalWarpInMemory(input, cloneOut, pcrOutput = output, **warpOptions)
+        return
+    # 
+    # temporary files (unique names: only these are removed, tmpDir may be shared, see workspace):
+    tmpName = os.path.join(tmpDir, 'tmp_'+get_random_word(8))
+    tmpInp = tmpName+'_inp.tif'
+    tmpOut = tmpName+'_out.tif'
     # 
     # converting files to tif:
-    co = 'gdal_translate -ot Float32 -a_nodata -3.4028234663852886e+38 '+str(input)+' '+str(tmpDir)+'tmp_inp.tif'
-    if isLddMap == True: co = 'gdal_translate -ot Int32 '+str(input)+' '+str(tmpDir)+'tmp_inp.tif'
-    if isNominalMap == True: co = 'gdal_translate -ot Int32 '+str(input)+' '+str(tmpDir)+'tmp_inp.tif'
+    co = 'gdal_translate -ot Float32 -a_nodata -3.4028234663852886e+38 '+str(input)+' '+tmpInp
+    if isLddMap == True: co = 'gdal_translate -ot Int32 '+str(input)+' '+tmpInp
+    if isNominalMap == True: co = 'gdal_translate -ot Int32 '+str(input)+' '+tmpInp
     
     msg = "Execute from the command line:\n\n"+co+"\n\n"
     logger.debug(msg)     
     
+    instrumentation.count("subprocess launches")
     cOut,err = subprocess.Popen(co, stdout=subprocess.PIPE,stderr=open(os.devnull),shell=True).communicate()
     # 
     # get the attributes of PCRaster map:
@@ -619,8 +1228,8 @@ def gdalwarpPCR(input,output,cloneOut,tmpDir,isLddMap=False,isNominalMap=False,i
     tr = '-tr '+str(xres)+' '+str(yres)+' '
     co = 'gdalwarp '+te+tr+ \
          ' -srcnodata -3.4028234663852886e+38 -dstnodata -3.4028234663852886e+38 '+ \
-           str(tmpDir)+'tmp_inp.tif '+ \
-           str(tmpDir)+'tmp_out.tif'
+           tmpInp+' '+ \
+           tmpOut
     if inputEPSG != "default" or outputEPSG != "default" or method != "default":
         co = 'gdalwarp '+\
              '-s_srs '+inputEPSG+" "+\
@@ -628,35 +1237,81 @@ def gdalwarpPCR(input,output,cloneOut,tmpDir,isLddMap=False,isNominalMap=False,i
              te+tr+" "+\
              '-r '+method+\
              ' -srcnodata -3.4028234663852886e+38 -dstnodata -3.4028234663852886e+38 '+ \
-             str(tmpDir)+'tmp_inp.tif '+ \
-             str(tmpDir)+'tmp_out.tif'
+             tmpInp+' '+ \
+             tmpOut
         msg = "Execute from the command line:\n\n"+co+"\n\n"
         logger.debug(msg)     
+    instrumentation.count("subprocess launches")
     cOut,err = subprocess.Popen(co, stdout=subprocess.PIPE,stderr=open(os.devnull),shell=True).communicate()
     # 
     co = 'gdal_translate -of PCRaster -a_nodata -3.4028234663852886e+38 '+ \
-              str(tmpDir)+'tmp_out.tif '+str(output)
+              tmpOut+' '+str(output)
 
     msg = "Execute from the command line:\n\n"+co+"\n\n"
     logger.debug(msg)     
 
+    instrumentation.count("subprocess launches")
     cOut,err = subprocess.Popen(co, stdout=subprocess.PIPE,stderr=open(os.devnull),shell=True).communicate()
     # 
     co = 'mapattr -c '+str(cloneOut)+' '+str(output)
+    instrumentation.count("subprocess launches")
     cOut,err = subprocess.Popen(co, stdout=subprocess.PIPE,stderr=open(os.devnull),shell=True).communicate()
     # 
     #~ co = 'aguila '+str(output)
     #~ print(co)
     #~ cOut,err = subprocess.Popen(co, stdout=subprocess.PIPE,stderr=open(os.devnull),shell=True).communicate()
     # 
-    co = 'rm '+str(tmpDir)+'tmp*.*'
-    cOut,err = subprocess.Popen(co, stdout=subprocess.PIPE,stderr=open(os.devnull),shell=True).communicate()
+    for tmpFile in glob.glob(tmpName+'_*'): os.remove(tmpFile)
     co = None; cOut = None; err = None
     del co; del cOut; del err
     stdout = None; del stdout
     stderr = None; del stderr
     n = gc.collect() ; del gc.garbage[:] ; n = None ; del n
 
+def readCatchmentTifClone(inputTifFile,cloneMapFileName,tmpDir):
+    # To resample a catchment tif file to the extent of the clone map and read it as a nominal PCRaster map.
+    # - with the GDAL python bindings, this is done in memory (the clone map must be set as the pcraster clone).
+    # - otherwise, temporary files are named after the input file so that several catchments can share tmpDir.  
+    cloneAtt = getMapAttributesALL(cloneMapFileName)
+    xmin = cloneAtt['xUL']
+    ymin = cloneAtt['yUL'] - cloneAtt['rows']*cloneAtt['cellsize']
+    xmax = cloneAtt['xUL'] + cloneAtt['cols']*cloneAtt['cellsize']
+    ymax = cloneAtt['yUL'] 
+    corner_coordinates = [str(xmin), str(ymin), str(xmax), str(ymax)]
+    if gdal != None:
+        # in-process: warp in memory (the source data type and missing value are kept, as in gdalwarp) 
+        data, missingValue = gdalWarpInMemory(inputTifFile, cloneMapFileName)
+        # - nominal values (as pcrcalc nominal)
+        missing = np.isnan(data)
+        if missingValue != None: missing |= (data == missingValue)
+        nominalMV = int(np.iinfo(np.int32).min)
+        data = np.where(missing, nominalMV, data).astype(np.int32)
+        catchment = pcr.numpy2pcr(pcr.Nominal, data, nominalMV)
+        return catchment
+    tmp_name = os.path.splitext(os.path.basename(inputTifFile))[0]
+    tmp_tif  = os.path.join(tmpDir, tmp_name + "_tmp.tif")
+    tmp_map  = os.path.join(tmpDir, tmp_name + "_catchment.map")
+    # resample tif to the extent of the clone (without a shell; a failing command raises CalledProcessError)
+    cmd = ['gdalwarp', '-te'] + corner_coordinates + [inputTifFile, tmp_tif]
+    instrumentation.count("subprocess launches")
+    logger.debug(' '.join(cmd))
+    subprocess.check_call(cmd, stdout = open(os.devnull, 'w'))
+    # - convert to a pcraster map 
+    cmd = ['pcrcalc', tmp_map + ' = nominal(' + tmp_tif + ')']
+    instrumentation.count("subprocess launches")
+    logger.debug(' '.join(cmd))
+    subprocess.check_call(cmd, stdout = open(os.devnull, 'w'))
+    #~ # - make sure that it has a good projection system
+    #~ cmd = 'mapattr -s -P yb2t ' + tmp_map
+    catchment = pcr.readmap(tmp_map)
+    return catchment
+
+def getStationID(tifCatchmentFile):
+    # station id of a catchment tif file, e.g. stID_003303.tif -> 003303
+    stationID = os.path.splitext(os.path.basename(tifCatchmentFile))[0]
+    if stationID.startswith("stID_"): stationID = stationID[len("stID_"):]
+    return stationID
+
 def getFullPath(inputPath,absolutePath,completeFileName = True):
     # 19 Mar 2013 created by Edwin H. Sutanudjaja
     # Function: to get the full absolute path of a folder or a file
@@ -676,16 +1331,16 @@ def getFullPath(inputPath,absolutePath,completeFileName = True):
         if absolutePath.endswith('/'): 
             absolutePath = str(absolutePath)
         else:
-			absolutePath = str(absolutePath)+'/'    
+            absolutePath = str(absolutePath)+'/'
         fullPath = str(absolutePath)+str(inputPath)
     
     if completeFileName:
         if fullPath.endswith(suffix): 
             fullPath = str(fullPath)
-    	else:
+        else:
             fullPath = str(fullPath)+'/'    
 
-    return fullPath    		
+    return fullPath
 
 def findISIFileName(year,model,rcp,prefix,var):
     histYears = [1951,1961,1971,1981,1991,2001]
@@ -747,11 +1402,85 @@ def isLastDayOfMonth(date):
     else:
         return False
 
+def readCSFHeader(mapFile):
+    # Read the main and raster headers of a PCRaster CSF map file without
+    # calling the 'mapattr' command line tool. 
+    # Returns None if the file is not a CSF map.
+    with open(mapFile, 'rb') as f:
+        header = f.read(CSF_HEADER_SIZE)
+    if len(header) < CSF_HEADER_SIZE or not header.startswith(CSF_SIGNATURE):
+        return None
+    # CSF maps are stored in the byte order of the machine that wrote them;
+    # the 'byteOrder' field is 1 when read in the order of that machine.   
+    endian = '<'
+    if struct.unpack('<I', header[46:50])[0] != 1: endian = '>'
+    valueScale, cellRepr = struct.unpack(endian + 'HH', header[64:68])
+    xUL, yUL             = struct.unpack(endian + 'dd', header[84:100])
+    rows, cols           = struct.unpack(endian + 'II', header[100:108])
+    cellSizeX, cellSizeY = struct.unpack(endian + 'dd', header[108:124])
+    angle                = struct.unpack(endian + 'd' , header[124:132])[0]
+    csfHeader = {'version'   : struct.unpack(endian + 'H', header[32:34])[0],\
+                 'projection': struct.unpack(endian + 'H', header[38:40])[0],\
+                 'valueScale': valueScale,\
+                 'cellRepr'  : cellRepr  ,\
+                 'xUL'       : xUL       ,\
+                 'yUL'       : yUL       ,\
+                 'rows'      : rows      ,\
+                 'cols'      : cols      ,\
+                 'cellsize'  : cellSizeX ,\
+                 'cellsizeY' : cellSizeY ,\
+                 'angle'     : angle     }
+    return csfHeader
+
 def getMapAttributesALL(cloneMap,arcDegree=True):
+    # EHS: The map attributes are read directly from the CSF header (no 'mapattr' subprocess). 
+    #      Results are cached based on the file path, modification time and size.
+    try:
+        fileStat = os.stat(cloneMap)
+    except OSError:
+        print("Something wrong with mattattr in virtualOS, maybe clone Map does not exist ? ")
+        sys.exit()
+    cacheKey = (os.path.abspath(cloneMap), fileStat.st_mtime, fileStat.st_size, arcDegree)
+    if cacheKey in mapattrcache:
+        return dict(mapattrcache[cacheKey])
+    
+    csfHeader = readCSFHeader(cloneMap)
+    if csfHeader != None:
+        cellsize = csfHeader['cellsize']
+        if arcDegree == True: cellsize = round(cellsize * 360000.)/360000.
+        mapAttr = {'cellsize': float(cellsize)           ,\
+                   'rows'    : float(csfHeader['rows'])  ,\
+                   'cols'    : float(csfHeader['cols'])  ,\
+                   'xUL'     : float(csfHeader['xUL'])   ,\
+                   'yUL'     : float(csfHeader['yUL'])}
+    elif gdal != None:
+        # not a CSF file (e.g. a tif file), use GDAL  
+        mapAttr = getMapAttributesUsingGdal(cloneMap, arcDegree)
+    else:
+        # not a CSF file, use 'mapattr' as the fallback 
+        mapAttr = getMapAttributesUsingMapattr(cloneMap, arcDegree)
+    
+    mapattrcache[cacheKey] = mapAttr
+    return dict(mapAttr)
+
+def getMapAttributesUsingGdal(cloneMap,arcDegree=True):
+    ds = gdal.Open(str(cloneMap))
+    xUL, cellsize, rotationX, yUL, rotationY, cellsizeY = ds.GetGeoTransform()
+    if arcDegree == True: cellsize = round(cellsize * 360000.)/360000.
+    mapAttr = {'cellsize': float(cellsize)        ,\
+               'rows'    : float(ds.RasterYSize)  ,\
+               'cols'    : float(ds.RasterXSize)  ,\
+               'xUL'     : float(xUL)             ,\
+               'yUL'     : float(yUL)}
+    ds = None
+    return mapAttr 
+
+def getMapAttributesUsingMapattr(cloneMap,arcDegree=True):
+    instrumentation.count("subprocess launches")
     cOut,err = subprocess.Popen(str('mapattr -p %s ' %(cloneMap)), stdout=subprocess.PIPE,stderr=open(os.devnull),shell=True).communicate()
 
     if err !=None or cOut == []:
-        print "Something wrong with mattattr in virtualOS, maybe clone Map does not exist ? "
+        print("Something wrong with mattattr in virtualOS, maybe clone Map does not exist ? ")
         sys.exit()
     cellsize = float(cOut.split()[7])
     if arcDegree == True: cellsize = round(cellsize * 360000.)/360000.
@@ -760,36 +1489,51 @@ def getMapAttributesALL(cloneMap,arcDegree=True):
                'cols'    : float(cOut.split()[5]) ,\
                'xUL'     : float(cOut.split()[17]),\
                'yUL'     : float(cOut.split()[19])}
-    co = None; cOut = None; err = None
-    del co; del cOut; del err
-    n = gc.collect() ; del gc.garbage[:] ; n = None ; del n
     return mapAttr 
 
 def getMapAttributes(cloneMap,attribute,arcDegree=True):
-    cOut,err = subprocess.Popen(str('mapattr -p %s ' %(cloneMap)), stdout=subprocess.PIPE,stderr=open(os.devnull),shell=True).communicate()
-    #print cOut
-    if err !=None or cOut == []:
-        print "Something wrong with mattattr in virtualOS, maybe clone Map does not exist ? "
-        sys.exit()
-    #print cOut.split()
-    co = None; err = None
-    del co; del err
-    n = gc.collect() ; del gc.garbage[:] ; n = None ; del n
+    mapAttr = getMapAttributesALL(cloneMap, arcDegree)
     if attribute == 'cellsize':
-        cellsize = float(cOut.split()[7])
-        if arcDegree == True: cellsize = round(cellsize * 360000.)/360000.
-        return cellsize  
+        return mapAttr['cellsize']  
     if attribute == 'rows':
-        return int(cOut.split()[3])
-        #return float(cOut.split()[3])
+        return int(mapAttr['rows'])
     if attribute == 'cols':
-        return int(cOut.split()[5])
-        #return float(cOut.split()[5])
+        return int(mapAttr['cols'])
     if attribute == 'xUL':
-        return float(cOut.split()[17])
+        return mapAttr['xUL']
     if attribute == 'yUL':
-        return float(cOut.split()[19])
+        return mapAttr['yUL']
     
+def getCellAreaGrid(cellsize, rows, cols, yUL, dtype = np.float64, radius = None):
+    # Cell area (m2) of a regular latitude/longitude grid (cellsize and yUL in arc-degrees), on a sphere:
+    #   A = R^2 * dlon * (sin(lat_north) - sin(lat_south))
+    # The areas are calculated once per row and broadcast across the columns (a read-only array). 
+    # The grids are kept in cellareacache (key: grid definition, radius and dtype).
+    if radius == None: radius = earthRadius
+    cacheKey = (float(cellsize), int(rows), int(cols), float(yUL), np.dtype(dtype).str, float(radius))
+    if cacheKey not in cellareacache.keys():
+        latNorth = np.radians(yUL - cellsize * np.arange(0, rows, dtype = np.float64))
+        latSouth = np.radians(yUL - cellsize * np.arange(1, rows + 1, dtype = np.float64))
+        rowArea  = radius**2 * np.radians(cellsize) * (np.sin(latNorth) - np.sin(latSouth))
+        cellareacache[cacheKey] = np.broadcast_to(rowArea.astype(dtype)[:,np.newaxis], (int(rows), int(cols)))
+    return cellareacache[cacheKey]
+
+def getCellAreaGridOfClone(cloneMapFileName, dtype = np.float64, radius = None):
+    # cell area (m2) of the grid of a clone map (see getCellAreaGrid)
+    attributeClone = getMapAttributesALL(cloneMapFileName)
+    return getCellAreaGrid(attributeClone['cellsize'], attributeClone['rows'], attributeClone['cols'], \
+                           attributeClone['yUL'], dtype, radius)
+
+def getCellAreaGridOfNC(ncFile, dtype = np.float64, radius = None):
+    # cell area (m2) of the (native) grid of a netcdf file, from north to south (as the fields of netcdf2NumpyClone
+    # before cropping; see getCellAreaGrid)
+    f = filecache.get(ncFile)
+    lat = f.variables['lat'][:]
+    lon = f.variables['lon'][:]
+    cellsize = abs(float(lat[0] - lat[1]))
+    yUL = float(max(lat[0], lat[-1])) + 0.5 * cellsize
+    return getCellAreaGrid(cellsize, len(lat), len(lon), yUL, dtype, radius)
+
 def getMapTotal(mapFile):
     ''' outputs the sum of all values in a map file '''
 
@@ -819,14 +1563,27 @@ def getLastDayOfMonth(date):
 
 
 
+def getMinMaxSumCount(mapFile,missingValue=None):
+    # Minimum, maximum, total (float64) and number of valid values of a PCRaster map (converted with pcr2numpy) 
+    # or a numpy array, from one selection of the valid values (so that getMinMaxMean needs a single call). 
+    # Missing values (PCRaster MV, nan and missingValue) are skipped. For an empty map, the minimum and maximum are nan.
+    if isinstance(mapFile, np.ndarray):
+        values = mapFile.ravel()
+    else:
+        values = pcr.pcr2numpy(pcr.scalar(mapFile), np.nan).ravel()
+    valid = ~np.isnan(values)
+    if missingValue != None: valid &= (values != missingValue)
+    if not valid.all(): values = values[valid]
+    if values.size == 0: return np.nan, np.nan, 0.0, 0
+    return float(values.min()), float(values.max()), float(values.sum(dtype = np.float64)), int(values.size)
+
 def getMinMaxMean(mapFile,ignoreEmptyMap=False):
-    mn = pcr.cellvalue(pcr.mapminimum(mapFile),1)[0]
-    mx = pcr.cellvalue(pcr.mapmaximum(mapFile),1)[0]
-    nrValues = pcr.cellvalue(pcr.maptotal(pcr.scalar(pcr.defined(mapFile))), 1 ) [0] #/ getNumNonMissingValues(mapFile)
-    if nrValues == 0.0 and ignoreEmptyMap: 
+    # - the statistics are calculated from one selection of the valid values (see getMinMaxSumCount)
+    mn, mx, total, nrValues = getMinMaxSumCount(mapFile)
+    if nrValues == 0 and ignoreEmptyMap: 
         return 0.0,0.0,0.0
     else:
-        return mn,mx,(getMapTotal(mapFile) / nrValues)
+        return mn,mx,(total / nrValues)
 
 def getMapVolume(mapFile,cellareaFile):
     ''' returns the sum of all grid cell values '''
@@ -861,7 +1618,7 @@ def retrieveMapValue(pcrX,coordinates):
     nrRows= coordinates.shape[0]
     x= np.ones((nrRows))* MV
     tmpIDArray= pcr.pcr2numpy(pcrX,MV)
-    for iCnt in xrange(nrRows):
+    for iCnt in range(nrRows):
       row,col= coordinates[iCnt,:]
       if row != MV and col != MV:
         x[iCnt]= tmpIDArray[row,col]
@@ -876,7 +1633,7 @@ def returnMapValue(pcrX,x,coord):
     #print tempIDArray
     temporary= tempIDArray
     nrRows= coord.shape[0]
-    for iCnt in xrange(nrRows):
+    for iCnt in range(nrRows):
       row,col= coord[iCnt,:]
       if row != MV and col != MV:
         tempIDArray[row,col]= (x[iCnt])
@@ -895,48 +1652,37 @@ def regridMapFile2FinerGrid (rescaleFac,coarse):
     return pcr.numpy2pcr(pcr.Scalar, regridData2FinerGrid(rescaleFac,pcr.pcr2numpy(coarse,MV),MV),MV)
     
 def regridData2FinerGrid(rescaleFac,coarse,MV):
+    # Every coarse cell is repeated rescaleFac x rescaleFac times (in one vectorized copy of a broadcast view). 
+    # The dtype of the input is kept. MV is not used anymore (all fine cells are filled with the coarse values). 
+    # (Reductions over the catchment cells do not need the fine grid, see sparse_catchment.getCoarseWeights.)
     if rescaleFac ==1:
         return coarse
+    coarse = np.ma.getdata(coarse)
     nr,nc = np.shape(coarse)
-    
-    fine= np.zeros(nr*nc*rescaleFac*rescaleFac).reshape(nr*rescaleFac,nc*rescaleFac) + MV
-    
- 
-    ii = -1
-    nrF,ncF = np.shape(fine)
-    for i in range(0 , nrF):
-            if i % rescaleFac == 0:
-                ii += 1
-            fine [i,:] = coarse[ii,:].repeat(rescaleFac)
-
-    nr = None; nc = None
-    del nr; del nc
-    nrF = None; ncF = None
-    del nrF; del ncF
-    n = gc.collect() ; del gc.garbage[:] ; n = None ; del n
+    fine = np.broadcast_to(coarse[:,np.newaxis,:,np.newaxis], (nr,rescaleFac,nc,rescaleFac)).reshape(nr*rescaleFac,nc*rescaleFac)
     return fine
 
 def regridToCoarse(fine,fac,mode,missValue):
+    # All coarse cells are calculated at once: the fine grid is reshaped to blocks of fac x fac cells 
+    # that are reduced with masked array operations. Coarse cells without any valid value get MV.
     nr,nc = np.shape(fine)
-    coarse = np.zeros(nr/fac * nc / fac).reshape(nr/fac,nc/fac) + MV
-    nr,nc = np.shape(coarse)
-    for r in range(0,nr):
-        for c in range(0,nc):
-            ar = fine[r * fac : fac * (r+1),c * fac: fac * (c+1)]
-            m = np.ma.masked_values(ar,missValue)
-            if ma.count(m) == 0:
-                coarse[r,c] = MV
-            else:
-                if mode == 'average':
-                    coarse [r,c] = ma.average(m)
-                elif mode == 'median': 
-                    coarse [r,c] = ma.median(m)
-                elif mode == 'sum':
-                    coarse [r,c] = ma.sum(m)
-                elif mode =='min':
-                    coarse [r,c] = ma.min(m)
-                elif mode == 'max':
-                    coarse [r,c] = ma.max(m)
+    nr = nr // fac ; nc = nc // fac
+    m = np.ma.masked_values(np.asarray(fine)[0:nr*fac,0:nc*fac],missValue)
+    # - shape: (nr, nc, fac * fac)
+    blocks = m.reshape(nr,fac,nc,fac).swapaxes(1,2).reshape(nr,nc,fac*fac)
+    if mode == 'average':
+        coarse = ma.average(blocks, axis = 2)
+    elif mode == 'median': 
+        coarse = ma.median(blocks, axis = 2)
+    elif mode == 'sum':
+        coarse = ma.sum(blocks, axis = 2)
+    elif mode =='min':
+        coarse = ma.min(blocks, axis = 2)
+    elif mode == 'max':
+        coarse = ma.max(blocks, axis = 2)
+    else:
+        return np.zeros((nr,nc)) + MV
+    coarse = ma.filled(ma.masked_where(ma.count(blocks, axis = 2) == 0, coarse).astype(np.float64), MV)
     return coarse    
         
     
@@ -944,6 +1690,9 @@ def waterBalanceCheck(fluxesIn,fluxesOut,preStorages,endStorages,processName,Pri
     """ Returns the water balance for a list of input, output, and storage map files  """
     # modified by Edwin (22 Apr 2013)
 
+    # skipped entirely if the checks are switched off (e.g. in production runs, see waterBalanceChecks)
+    if not waterBalanceChecks: return
+
     inMap   = pcr.spatial(pcr.scalar(0.0))
     outMap  = pcr.spatial(pcr.scalar(0.0))
     dsMap   = pcr.spatial(pcr.scalar(0.0))
@@ -959,21 +1708,7 @@ def waterBalanceCheck(fluxesIn,fluxesOut,preStorages,endStorages,processName,Pri
 
     a,b,c = getMinMaxMean(inMap + dsMap- outMap)
     if abs(a) > threshold or abs(b) > threshold:
-        if PrintOnlyErrors: 
-            
-            msg  = "\n"
-            msg += "\n"
-            msg  = "\n"
-            msg += "\n"
-            msg += "##############################################################################################################################################\n"
-            msg += "WARNING !!!!!!!! Water Balance Error %s Min %f Max %f Mean %f" %(processName,a,b,c)
-            msg += "\n"
-            msg += "##############################################################################################################################################\n"
-            msg += "\n"
-            msg += "\n"
-            msg += "\n"
-            
-            logger.error(msg)
+        if PrintOnlyErrors: reportWaterBalanceError(processName,a,b,c)
 
             #~ pcr.report(inMap + dsMap - outMap,"wb.map")
             #~ os.system("aguila wb.map")
@@ -989,6 +1724,21 @@ def waterBalanceCheck(fluxesIn,fluxesOut,preStorages,endStorages,processName,Pri
     #~ maxWBError = pcr.cellvalue(pcr.mapmaximum(pcr.abs(wb)), 1, 1)[0]
     #~ #return wb
 
+def reportWaterBalanceError(processName,a,b,c):
+    # a, b, c: minimum, maximum and mean of the water balance error (see waterBalanceCheck)
+    msg  = "\n"
+    msg += "\n"
+    msg  = "\n"
+    msg += "\n"
+    msg += "##############################################################################################################################################\n"
+    msg += "WARNING !!!!!!!! Water Balance Error %s Min %f Max %f Mean %f" %(processName,a,b,c)
+    msg += "\n"
+    msg += "##############################################################################################################################################\n"
+    msg += "\n"
+    msg += "\n"
+    msg += "\n"
+    
+    logger.error(msg)
 
 
 
@@ -998,25 +1748,24 @@ def waterBalance(  fluxesIn,  fluxesOut,  deltaStorages,  processName,   PrintOn
     inMap = pcr.spatial(pcr.scalar(0.0))
     dsMap = pcr.spatial(pcr.scalar(0.0))
     outMap = pcr.spatial(pcr.scalar(0.0))
-    inflow = 0
-    outflow = 0
-    deltaS = 0
+    # - the totals of the fluxes (getMapTotal: one pass for every flux) are only needed for the messages below 
+    #   (commented out), so they are not calculated anymore
     for fluxIn in fluxesIn:
-        inflow += getMapTotal(fluxIn)
         inMap += fluxIn
     for fluxOut in fluxesOut:
-        outflow += getMapTotal(fluxOut)
         outMap += fluxOut
     for deltaStorage in deltaStorages:
-        deltaS += getMapTotal(deltaStorage)
         dsMap += deltaStorage
 
+    # the check is skipped if the checks are switched off (see waterBalanceChecks)
+    if not waterBalanceChecks: return inMap + dsMap - outMap
+
     #if PrintOnlyErrors:
     a,b,c = getMinMaxMean(inMap + dsMap- outMap)
     # if abs(a) > 1e-5 or abs(b) > 1e-5:
     # if abs(a) > 1e-4 or abs(b) > 1e-4:
     if abs(a) > threshold or abs(b) > threshold:
-        print "WBError %s Min %f Max %f Mean %f" %(processName,a,b,c)
+        print("WBError %s Min %f Max %f Mean %f" %(processName,a,b,c))
     #    if abs(inflow + deltaS - outflow) > 1e-5:
     #        print "Water balance Error for %s on %s: in = %f\tout=%f\tdeltaS=%f\tBalance=%f" \
     #        %(processName,dateStr,inflow,outflow,deltaS,inflow + deltaS - outflow)
@@ -1024,9 +1773,9 @@ def waterBalance(  fluxesIn,  fluxesOut,  deltaStorages,  processName,   PrintOn
     #   print "Water balance for %s: on %s in = %f\tout=%f\tdeltaS=%f\tBalance=%f" \
     #        %(processName,dateStr,inflow,outflow,deltaS,inflow + deltaS - outflow)
 
-    wb = inMap + dsMap - outMap
-    maxWBError = pcr.cellvalue(pcr.mapmaximum(pcr.abs(wb)), 1, 1)[0]
-
+    #~ wb = inMap + dsMap - outMap
+    #~ maxWBError = pcr.cellvalue(pcr.mapmaximum(pcr.abs(wb)), 1, 1)[0]     # = max(abs(a), abs(b))
+    
     #if maxWBError > 0.001 / 1000:
         #row = 0
         #col = 0
@@ -1092,7 +1841,7 @@ def waterAbstractionAndAllocation(water_demand_volume,available_water_volume,all
     
     # total available water volume in each zone/segment (unit: m3)
     # - to minimize numerical errors, separating cellAvlWater 
-    if not isinstance(high_volume_treshold,types.NoneType):
+    if not isinstance(high_volume_treshold,type(None)):
         # mask: 0 for small volumes ; 1 for large volumes (e.g. in lakes and reservoirs)
         mask = pcr.cover(\
                pcr.ifthen(cellAvlWater > high_volume_treshold, pcr.boolean(1)), pcr.boolean(0))
@@ -1114,7 +1863,7 @@ def waterAbstractionAndAllocation(water_demand_volume,available_water_volume,all
     if ignore_small_values: # ignore small values to avoid runding error
         cellAbstraction = pcr.rounddown(pcr.max(0.00, cellAbstraction))
     # to minimize numerical errors, separating cellAbstraction 
-    if not isinstance(high_volume_treshold,types.NoneType):
+    if not isinstance(high_volume_treshold,type(None)):
         # mask: 0 for small volumes ; 1 for large volumes (e.g. in lakes and reservoirs)
         mask = pcr.cover(\
                pcr.ifthen(cellAbstraction > high_volume_treshold, pcr.boolean(1)), pcr.boolean(0))
@@ -1149,7 +1898,7 @@ def waterAbstractionAndAllocation(water_demand_volume,available_water_volume,all
                           #~ pcr.areatotal(remainingCellDemand, allocation_zones), 
                           #~ smallNumber)                        
     
-    if debug_water_balance and not isinstance(zone_area,types.NoneType):
+    if debug_water_balance and not isinstance(zone_area,type(None)):
 
         zoneAbstraction = pcr.cover(pcr.areatotal(cellAbstraction, allocation_zones)/zone_area, 0.0)
         zoneAllocation  = pcr.cover(pcr.areatotal(cellAllocation , allocation_zones)/zone_area, 0.0)
@@ -1164,18 +1913,118 @@ def waterAbstractionAndAllocation(water_demand_volume,available_water_volume,all
     
     return cellAbstraction, cellAllocation
 
+def getZoneIndex(allocation_zones):
+    # To convert the zone IDs (a nominal PCRaster map or a numpy array) to flat zone indexes (int64; 0 to the 
+    # number of zones - 1, -1 for missing zones). Returns the zone indexes and the number of zones.
+    if isinstance(allocation_zones, np.ndarray):
+        zoneIDs = allocation_zones.ravel()
+        valid = np.ones(zoneIDs.shape, dtype = bool)
+        if zoneIDs.dtype.kind == 'f': valid = ~np.isnan(zoneIDs) & (zoneIDs != MV)
+    else:
+        nominalMV = int(np.iinfo(np.int32).min)
+        zoneIDs = pcr.pcr2numpy(pcr.nominal(allocation_zones), nominalMV).ravel()
+        valid = zoneIDs != nominalMV
+    zoneIndex = np.full(zoneIDs.shape, -1, dtype = np.int64)
+    uniqueIDs, zoneIndex[valid] = np.unique(zoneIDs[valid], return_inverse = True)
+    return zoneIndex, len(uniqueIDs)
+
+def getZoneTotals(values, zoneIndex, numberOfZones):
+    # Totals (float64) of the values (flat, nan for missing values) in every zone (see getZoneIndex), with one 
+    # np.bincount, i.e. accumulated in float64 (missing values are skipped, as in pcr.areatotal).
+    valid = (zoneIndex >= 0) & ~np.isnan(values)
+    return np.bincount(zoneIndex[valid], weights = values[valid], minlength = numberOfZones)
+
+def waterAbstractionAndAllocationNumpy(water_demand_volume,available_water_volume,allocation_zones,\
+                                       zone_area = None,
+                                       high_volume_treshold = 1000000.,
+                                       debug_water_balance = True,\
+                                       extra_info_for_water_balance_reporting = "",
+                                       ignore_small_values = True):
+    # As waterAbstractionAndAllocation, but calculated with numpy on flat arrays: the zone totals are calculated 
+    # with np.bincount (see getZoneTotals) instead of pcr.areatotal, once for every variable. 
+    # - The inputs are PCRaster maps (the results are PCRaster maps) or numpy arrays (with nan or MV for missing 
+    #   values; the results are numpy arrays with MV for missing values).
+    # - The totals are accumulated in float64, so the small and large volumes (high_volume_treshold) do not have 
+    #   to be added separately (high_volume_treshold is not used).
+    # - All values are calculated in float64 (PCRaster: float32), so the results can differ by the float32 rounding.
+
+    logger.debug("Allocation of abstraction (numpy).")
+
+    numpyInput = isinstance(water_demand_volume, np.ndarray)
+    def toNumpy(values):
+        if isinstance(values, np.ndarray):
+            values = values.astype(np.float64).ravel()
+            return np.where(values == MV, np.nan, values)
+        return pcr.pcr2numpy(pcr.scalar(values), np.nan).astype(np.float64).ravel()
+    def getValDivZeroNumpy(x, y, y_lim = smallNumber):
+        # see getValDivZero (missing values are kept)
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            z = np.where(y > y_lim, x / np.maximum(y_lim, y), 0.0)
+        z[np.isnan(x) | np.isnan(y)] = np.nan
+        return z
+
+    waterDemand = toNumpy(water_demand_volume)
+    availWater  = toNumpy(available_water_volume)
+    zoneIndex, numberOfZones = getZoneIndex(allocation_zones)
+    def zoneTotalOfCells(values):
+        # the zone totals at the cells (nan for missing zones, as pcr.areatotal)
+        zoneTotals = getZoneTotals(values, zoneIndex, numberOfZones)
+        return np.where(zoneIndex >= 0, zoneTotals[zoneIndex], np.nan)
+
+    # demand volume in each cell (unit: m3)
+    cellVolDemand = np.maximum(0.0, waterDemand)
+    if ignore_small_values: cellVolDemand = np.floor(cellVolDemand)           # ignore small values to avoid runding error
+
+    # total demand volume in each zone/segment (unit: m3)
+    zoneVolDemand = zoneTotalOfCells(cellVolDemand)
+
+    # total available water volume in each cell and zone/segment (unit: m3)
+    cellAvlWater = np.maximum(0.0, availWater)
+    if ignore_small_values: cellAvlWater = np.floor(cellAvlWater)             # ignore small values to avoid runding error
+    zoneAvlWater = zoneTotalOfCells(cellAvlWater)
+
+    # total actual water abstraction volume in each zone/segment (unit: m3) - limited to available water
+    zoneAbstraction = np.minimum(zoneAvlWater, zoneVolDemand)
+
+    # actual water abstraction volume in each cell (unit: m3)
+    cellAbstraction = getValDivZeroNumpy(cellAvlWater, zoneAvlWater) * zoneAbstraction
+    cellAbstraction = np.minimum(cellAbstraction, cellAvlWater)
+    if ignore_small_values: cellAbstraction = np.floor(np.maximum(0.0, cellAbstraction))
+    zoneAbstraction = zoneTotalOfCells(cellAbstraction)
+
+    # allocation water to meet water demand (unit: m3)
+    cellAllocation = getValDivZeroNumpy(cellVolDemand, zoneVolDemand) * zoneAbstraction
+
+    if debug_water_balance and not isinstance(zone_area,type(None)) and waterBalanceChecks:
+
+        zoneArea = toNumpy(zone_area)
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            zoneAbstraction = zoneTotalOfCells(cellAbstraction) / zoneArea
+            zoneAllocation  = zoneTotalOfCells(cellAllocation ) / zoneArea
+        # - as pcr.cover(..., 0.0)
+        zoneAbstraction = np.where(np.isfinite(zoneAbstraction), zoneAbstraction, 0.0)
+        zoneAllocation  = np.where(np.isfinite(zoneAllocation ), zoneAllocation , 0.0)
+
+        # see waterBalanceCheck (threshold = 1e-4)
+        a,b,c = getMinMaxMean(zoneAbstraction - zoneAllocation)
+        if abs(a) > 1e-4 or abs(b) > 1e-4:
+            reportWaterBalanceError('abstraction - allocation per zone/segment (PS: Error here may be caused by rounding error.)',a,b,c)
+
+    # results (MV for missing values)
+    shape = np.shape(water_demand_volume) if numpyInput else (pcr.clone().nrRows(), pcr.clone().nrCols())
+    cellAbstraction = np.where(np.isnan(cellAbstraction), MV, cellAbstraction).reshape(shape)
+    cellAllocation  = np.where(np.isnan(cellAllocation ), MV, cellAllocation ).reshape(shape)
+    if numpyInput: return cellAbstraction, cellAllocation
+    return pcr.numpy2pcr(pcr.Scalar, cellAbstraction, MV), pcr.numpy2pcr(pcr.Scalar, cellAllocation, MV)
+
 
 def findLastYearInNCFile(ncFile):
 
     # open a netcdf file:
-    if ncFile in filecache.keys():
-        f = filecache[ncFile]
-    else:
-        f = nc.Dataset(ncFile)
-        filecache[ncFile] = f
+    f = filecache.get(ncFile)
 
     # last datetime
-    last_datetime_year = findLastYearInNCTime(f.variables['time']) 
+    last_datetime_year = getNCTimeTable(ncFile, f.variables['time'])['last_year']
     
     return last_datetime_year
     
@@ -1203,6 +2052,7 @@ def cmd_line(command_line,using_subprocess = True):
     logger.debug(msg)
     
     co = command_line
+    instrumentation.count("subprocess launches")
     if using_subprocess:
         cOut,err = subprocess.Popen(co, stdout=subprocess.PIPE,stderr=open('/dev/null'),shell=True).communicate()
     else:
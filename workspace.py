@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Temporary workspaces: a unique folder for every run (or worker process), so that concurrent runs on the same node
+# never remove or overwrite each other's temporary files (e.g. the maps of vos.readPCRmapClone and vos.gdalwarpPCR).
+#
+# Workspaces are created on tmpfs (/dev/shm) if it has enough free space, otherwise in the fallback folder (e.g. the
+# output folder). They are removed at exit by the process that created them. Usage:
+#
+#   output_files['tmp_output_folder'] = workspace.createWorkspace(fallbackFolder = output_files['folder'])
+
+import os
+import shutil
+import atexit
+import tempfile
+import threading
+
+import logging
+logger = logging.getLogger(__name__)
+
+# preferred (tmpfs) folder and the free space (bytes) it must have
+shmFolder       = "/dev/shm"
+shmMinFreeBytes = 1024 * 1024 * 1024
+
+# workspaces (folder: process id of the creator) that are removed at exit
+workspaces = dict()
+_lock = threading.Lock()
+
+def getFreeBytes(folder):
+    fileSystem = os.statvfs(folder)
+    return fileSystem.f_bavail * fileSystem.f_frsize
+
+def getBaseFolder(fallbackFolder = None, minFreeBytes = None):
+    # the folder in which workspaces are created: shmFolder if it is writable and has enough free space,
+    # otherwise the fallback folder (default: the system temporary folder)
+    if minFreeBytes == None: minFreeBytes = shmMinFreeBytes
+    try:
+        if os.path.isdir(shmFolder) and os.access(shmFolder, os.W_OK) and getFreeBytes(shmFolder) >= minFreeBytes:
+            return shmFolder
+    except (OSError, AttributeError):
+        pass
+    if fallbackFolder == None: return tempfile.gettempdir()
+    if not os.path.isdir(fallbackFolder): os.makedirs(fallbackFolder)
+    return fallbackFolder
+
+def createWorkspace(prefix = "catchment_", fallbackFolder = None, minFreeBytes = None, baseFolder = None):
+    # To create a unique workspace folder (returned with a trailing separator), removed at exit.
+    # With baseFolder (e.g. set by the user), the workspace is always created in it (no free space check).
+    if baseFolder == None:
+        baseFolder = getBaseFolder(fallbackFolder, minFreeBytes)
+    elif not os.path.isdir(baseFolder):
+        os.makedirs(baseFolder)
+    folder = os.path.normpath(tempfile.mkdtemp(prefix = prefix + str(os.getpid()) + "_", dir = baseFolder))
+    with _lock:
+        workspaces[folder] = os.getpid()
+    logger.debug('The temporary workspace is: ' + str(folder))
+    return os.path.join(folder, "")
+
+def removeWorkspace(folder):
+    folder = os.path.normpath(folder)
+    with _lock:
+        workspaces.pop(folder, None)
+    shutil.rmtree(folder, ignore_errors = True)
+
+def removeAllWorkspaces():
+    # only the workspaces created by this process (not those of the parent of a forked worker process)
+    with _lock:
+        folders = [folder for folder, pid in workspaces.items() if pid == os.getpid()]
+    for folder in folders: removeWorkspace(folder)
+
+atexit.register(removeAllWorkspaces)